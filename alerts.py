@@ -0,0 +1,327 @@
+import asyncio
+import collections
+import json
+import ssl
+import time
+from urllib.parse import urlsplit, quote_plus
+import db
+
+
+class HTTPPool:
+    """
+    Минимальный HTTP/1.1 клиент с постоянными соединениями (keep-alive).
+
+    Соединения к одному адресу (схема, хост, порт) переиспользуются между запросами,
+    одновременных запросов к одному адресу - не больше limit.
+    Если переиспользованное соединение оказалось закрыто шлюзом,
+    запрос один раз повторяется на новом соединении.
+    """
+
+    _TIMEOUT = 10  # таймаут запроса, сек.
+    _IDLE_TIMEOUT = 60  # соединение, простоявшее дольше, не переиспользуется
+
+    def __init__(self, limit=4):
+        self.limit = limit
+        self._idle = {}  # адрес -> [(reader, writer, время освобождения), ...]
+        self._limits = {}  # адрес -> asyncio.Semaphore
+        self._ssl = None
+        self.opened = 0  # всего открыто соединений
+        self.requests = 0  # всего выполнено запросов
+
+    async def request(self, method, url, body=b'', headers=None):
+        """выполнить запрос, вернёт код ответа; при сетевой ошибке - исключение OSError/TimeoutError"""
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        address = (parts.scheme, parts.hostname, parts.port or (443 if https else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        head = [f'{method} {target} HTTP/1.1', f'Host: {parts.netloc}', f'Content-Length: {len(body)}']
+        head += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        request = ('\r\n'.join(head) + '\r\n\r\n').encode('utf-8') + body
+
+        semaphore = self._limits.get(address)
+        if semaphore is None:
+            semaphore = self._limits[address] = asyncio.Semaphore(self.limit)
+        async with semaphore:
+            for attempt in range(2):
+                connection = self._take(address)
+                reused = connection is not None
+                if not reused:
+                    connection = await asyncio.wait_for(self._open(address), self._TIMEOUT)
+                try:
+                    status, keep_alive = await asyncio.wait_for(self._exchange(*connection, request), self._TIMEOUT)
+                except (OSError, EOFError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    connection[1].close()
+                    if reused and not attempt:
+                        continue
+                    raise OSError(f'HTTP request to {parts.netloc} failed')
+                self.requests += 1
+                if keep_alive:
+                    self._idle.setdefault(address, []).append((*connection, time.monotonic()))
+                else:
+                    connection[1].close()
+                return status
+
+    def _take(self, address):
+        # свободное соединение к адресу, или None
+        idle = self._idle.get(address)
+        while idle:
+            reader, writer, released = idle.pop()
+            if time.monotonic() - released < self._IDLE_TIMEOUT and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def _open(self, address):
+        scheme, host, port = address
+        context = None
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            context = self._ssl
+        connection = await asyncio.open_connection(host, port, ssl=context)
+        self.opened += 1
+        return connection
+
+    @staticmethod
+    async def _exchange(reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+        version, status = (await reader.readline()).decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        connection = headers.get('connection', '')
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if not size:
+                    break
+        elif 'content-length' in headers:
+            await reader.readexactly(int(headers['content-length']))
+        else:
+            await reader.read()  # тело до закрытия соединения
+            keep_alive = False
+        return int(status), keep_alive
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer, _ in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class AlertDispatcher:
+    """
+    Отправка SMS оповещений.
+
+    Пингер только кладёт оповещение в ограниченную очередь (push), отправкой занимается
+    одна фоновая задача: раз в _BATCH_WINDOW сек. она забирает из очереди всё накопившееся,
+    сохраняет в таблицу alerts (неотправленные оповещения переживают перезапуск сервера)
+    и отправляет по одному запросу на получателя со всеми его сообщениями,
+    через постоянные соединения HTTPPool. Неудачные отправки повторяются с растущей паузой,
+    оповещения старше _MAX_AGE отбрасываются.
+
+    Получатели:
+    - url из настроек оповещений хоста (online_url/offline_url) - GET запрос на этот адрес
+      на каждое оповещение (текста в запросе нет, поэтому оповещения не объединяются);
+    - если url не задан - все номера из таблицы phones через шлюз из таблицы sms_api_data:
+      ip - адрес шлюза (host[:port]), gateway - путь запроса (или полный url),
+      post_request - шаблон тела POST запроса с подстановками {phone} и {text}
+      (если шаблон - JSON, значения экранируются для JSON, иначе - как в форме),
+      icmp_count - кол-во icmp дополнительной проверки перед оповещением об отключении.
+
+    Если очередь переполнена, оповещения не теряются бесследно:
+    вместо них получатели шлюза получат сводку с их количеством.
+    """
+
+    _QUEUE_SIZE = 10000
+    _BATCH_WINDOW = 2  # сек. накопления оповещений перед отправкой
+    _MAX_TEXTS = 20  # сообщений в одном SMS, остальные - одной строкой с количеством
+    _RETRY_BASE = 10  # пауза перед первой повторной отправкой, сек. (далее удваивается)
+    _RETRY_MAX = 600
+    _MAX_AGE = 86400  # сек.
+
+    def __init__(self, logger=None, database=None):
+        self.loop = asyncio.get_event_loop()
+        self.log = logger
+        self.database = database  # AsyncDB
+        self.queue = asyncio.Queue(maxsize=self._QUEUE_SIZE)
+        self.http = HTTPPool()
+        self._pending = collections.OrderedDict()  # получатель -> [[id, text, created, attempts, next_try], ...]
+        self._suppressed = 0  # оповещений, не поместившихся в очередь
+        self._sent = 0
+        self._failed = 0
+        self._expired = 0
+
+    def push(self, text, url=None):
+        """поставить оповещение в очередь; url - адрес оповещения хоста, None - номера из phones"""
+        try:
+            self.queue.put_nowait((url, text, int(time.time())))
+        except asyncio.QueueFull:
+            self._suppressed += 1
+
+    async def load(self):
+        """загрузить неотправленные оповещения из БД"""
+        await self.database.write(db.init_alerts)
+        for alert_id, recipient, text, created, attempts, next_try in await self.database.read(db.pending_alerts):
+            self._pending.setdefault(recipient, []).append([alert_id, text, created, attempts, next_try])
+
+    async def gateway(self):
+        """настройки шлюза из sms_api_data, или None"""
+        rows = await self.database.read(db.sms_api)
+        return rows[0] if rows else None
+
+    async def icmp_count(self, default=5):
+        """кол-во icmp дополнительной проверки хоста перед оповещением об отключении"""
+        try:
+            return int((await self.gateway())[3]) or default
+        except (Exception,):
+            return default
+
+    async def run(self):
+        await self.load()
+        while True:
+            try:
+                alert = await asyncio.wait_for(self.queue.get(), self._next_retry())
+            except asyncio.TimeoutError:
+                pass
+            else:
+                await asyncio.sleep(self._BATCH_WINDOW)
+                alerts = [alert]
+                while not self.queue.empty():
+                    alerts.append(self.queue.get_nowait())
+                await self._store(alerts)
+            try:
+                await self._deliver()
+            except (Exception,):
+                pass
+
+    def _next_retry(self):
+        # сек. до ближайшей повторной отправки, None - ждать новых оповещений
+        if not self._pending:
+            return None
+        next_try = min(alert[4] for alerts in self._pending.values() for alert in alerts)
+        return max(next_try - time.time(), 0.1)
+
+    async def _store(self, alerts):
+        # разложить оповещения по получателям и сохранить в БД
+        if self._suppressed:
+            alerts.append((None, f'Очередь оповещений переполнена, пропущено оповещений: {self._suppressed}',
+                           int(time.time())))
+            self._suppressed = 0
+        phones = None
+        rows = []
+        for url, text, created in alerts:
+            if url:
+                rows.append((url, text, created, 0, created))
+                continue
+            if phones is None:
+                phones = []
+                if await self.gateway():
+                    phones = [str(phone[0]) for phone in await self.database.read(db.phone_numbers)]
+                if not phones:
+                    self._alarm('SMS оповещения не отправлены: не настроен SMS шлюз или номера рассылки')
+            rows += [(phone, text, created, 0, created) for phone in phones]
+        if not rows:
+            return
+        ids = await self.database.write(db.insert_alerts, rows)
+        if ids == 'unknown error':
+            ids = [None] * len(rows)  # не сохранены в БД, но будут отправлены
+        for alert_id, (recipient, text, created, attempts, next_try) in zip(ids, rows):
+            self._pending.setdefault(recipient, []).append([alert_id, text, created, attempts, next_try])
+
+    async def _deliver(self):
+        # отправить оповещения получателям, для которых подошло время отправки
+        now = time.time()
+        due = [recipient for recipient, alerts in self._pending.items() if min(a[4] for a in alerts) <= now]
+        if not due:
+            return
+        gateway = await self.gateway()
+        results = await asyncio.gather(*(self._send(recipient, self._pending[recipient], gateway)
+                                         for recipient in due), return_exceptions=True)
+        delivered, retries = [], []
+        now = time.time()
+        for recipient, result in zip(due, results):
+            alerts = self._pending.pop(recipient)
+            sent = result if isinstance(result, int) else 0
+            if sent:
+                self._sent += sent
+                delivered += [alert[0] for alert in alerts[:sent]]
+                self._alarm(f'SMS оповещение отправлено <{recipient}>, сообщений: {sent}')
+                alerts = alerts[sent:]
+                if not alerts:
+                    continue
+            self._failed += 1
+            keep = []
+            for alert in alerts:
+                if now - alert[2] > self._MAX_AGE:
+                    self._expired += 1
+                    delivered.append(alert[0])
+                    continue
+                alert[3] += 1
+                alert[4] = int(now + min(self._RETRY_BASE * 2 ** (alert[3] - 1), self._RETRY_MAX))
+                retries.append((alert[3], alert[4], alert[0]))
+                keep.append(alert)
+            if keep:
+                self._pending[recipient] = keep
+            else:
+                self._alarm(f'SMS оповещения <{recipient}> не отправлены за сутки и удалены')
+        delivered = [alert_id for alert_id in delivered if alert_id is not None]
+        if delivered:
+            await self.database.write(db.delete_alerts, delivered)
+        retries = [row for row in retries if row[2] is not None]
+        if retries:
+            await self.database.write(db.update_alerts, retries)
+
+    async def _send(self, recipient, alerts, gateway):
+        # отправка получателю, вернёт кол-во доставленных оповещений (с начала списка)
+        if recipient.startswith(('http://', 'https://')):
+            sent = 0
+            for _ in alerts:
+                try:
+                    status = await self.http.request('GET', recipient)
+                except OSError:
+                    break
+                if not 200 <= status < 300:
+                    break
+                sent += 1
+            return sent
+        if gateway is None:
+            return 0
+        host, path, template = gateway[0], gateway[1] or '/', gateway[2] or ''
+        texts = [alert[1] for alert in alerts]
+        text = '\n'.join(texts[:self._MAX_TEXTS])
+        if len(texts) > self._MAX_TEXTS:
+            text += f'\n... и ещё {len(texts) - self._MAX_TEXTS}'
+        if template.lstrip().startswith('{'):
+            quote, content_type = (lambda value: json.dumps(value, ensure_ascii=False)[1:-1]), 'application/json'
+        else:
+            quote, content_type = quote_plus, 'application/x-www-form-urlencoded'
+        body = template.replace('{phone}', quote(recipient)).replace('{text}', quote(text))
+        url = path if '://' in path else f'http://{host}{path if path.startswith("/") else "/" + path}'
+        status = await self.http.request('POST', url, body.encode('utf-8'), {'Content-Type': content_type})
+        return len(alerts) if 200 <= status < 300 else 0
+
+    def _alarm(self, msg):
+        if self.log is not None:
+            self.log.alarm(msg)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'pending': sum(len(alerts) for alerts in self._pending.values()),
+            'recipients': len(self._pending),
+            'sent': self._sent,
+            'failed_requests': self._failed,
+            'expired': self._expired,
+            'suppressed': self._suppressed,
+            'connections_opened': self.http.opened,
+            'requests': self.http.requests,
+        }
@@ -0,0 +1,129 @@
+import asyncio
+import concurrent.futures
+import functools
+import queue
+import threading
+import db
+
+
+class AsyncDB:
+    """
+    Асинхронный доступ к функциям db.py: SQLite не выполняется в цикле событий.
+
+    - запись (write): все функции, меняющие БД, выполняет один поток записи.
+      Запросы, накопившиеся в очереди, пока выполнялась предыдущая транзакция,
+      выполняются следующей одной транзакцией (один commit на пачку);
+      каждая функция - в своей точке сохранения, поэтому её ошибка (rollback)
+      откатывает только её изменения, а не всю пачку;
+    - чтение (read): пул потоков, у каждого потока своё подключение
+      (в режиме WAL чтение идёт параллельно с записью).
+
+    Результат функции (или её исключение) вызывающий получает через await.
+    Future записи завершается после commit, поэтому чтение после await write
+    видит записанные данные. Из других потоков (поток записи лога) запись ставится
+    в ту же очередь через write_threadsafe.
+    """
+
+    _READERS = 4
+    _MAX_BATCH = 512  # функций в одной транзакции
+
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self._writes = queue.SimpleQueue()
+        self._closing = threading.Lock()
+        self._closed = False
+        self._readers = concurrent.futures.ThreadPoolExecutor(self._READERS, thread_name_prefix='db-read')
+        self._writer = threading.Thread(target=self._write_loop, name='db-write', daemon=True)
+        self._writer.start()
+        self.transactions = 0  # выполнено транзакций записи
+        self.writes = 0  # выполнено функций записи
+
+    def read(self, func, *args, **kwargs):
+        """выполнить функцию чтения db.py в пуле потоков, вернёт future"""
+        return self.loop.run_in_executor(self._readers, functools.partial(func, *args, **kwargs))
+
+    def write(self, func, *args, **kwargs):
+        """поставить функцию записи db.py в очередь потока записи, вернёт future"""
+        future = self.loop.create_future()
+        self._writes.put((future, func, args, kwargs))
+        return future
+
+    def write_threadsafe(self, func, *args, **kwargs):
+        """
+        то же, что write, для вызова не из цикла событий: вернёт concurrent.futures.Future,
+        или None, если поток записи уже остановлен (close)
+        """
+        future = concurrent.futures.Future()
+        with self._closing:
+            if self._closed:
+                return
+            self._writes.put((future, func, args, kwargs))
+        return future
+
+    def _write_loop(self):
+        base = db.connect(factory=db.BatchConnection)
+        while True:
+            item = self._writes.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self._MAX_BATCH:
+                try:
+                    item = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._writes.put(None)  # остановка после этой пачки
+                    break
+                batch.append(item)
+            results = self._run_batch(base, batch)
+            for (future, *_), result in zip(batch, results):
+                if isinstance(future, concurrent.futures.Future):
+                    self._resolve(future, *result)
+                else:
+                    self.loop.call_soon_threadsafe(self._resolve, future, *result)
+        db.close()
+
+    def _run_batch(self, base, batch):
+        # выполнить пачку функций одной транзакцией, вернёт [(результат, исключение), ...]
+        results = []
+        try:
+            base.execute('BEGIN')
+            base.batch = True
+            for _, func, args, kwargs in batch:
+                base.execute('SAVEPOINT call')
+                try:
+                    results.append((func(*args, **kwargs), None))
+                except Exception as error:
+                    base.rollback()  # откат только этой функции
+                    results.append((None, error))
+                base.execute('RELEASE call')
+            base.batch = False
+            base.commit()
+        except Exception as error:
+            base.batch = False
+            try:
+                base.rollback()
+            except Exception:
+                pass
+            return [(None, error)] * len(batch)
+        self.transactions += 1
+        self.writes += len(batch)
+        return results
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def close(self):
+        """дождаться записи очереди и остановить потоки"""
+        with self._closing:
+            self._closed = True
+            self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
@@ -0,0 +1,50 @@
+import base64
+import db
+
+
+class Credentials:
+    """
+    Учётные записи пользователей в памяти для авторизации TCP и HTTP клиентов.
+
+    Таблица users читается и декодируется один раз (через AsyncDB), дальше проверка
+    логина/пароля - поиск в словаре по логину, а проверка заголовка Authorization -
+    поиск в словаре заранее посчитанных значений 'Basic ...' всех пользователей.
+    Кэш сбрасывается (invalidate) при создании и удалении пользователей
+    и загружается заново при следующей проверке.
+    """
+
+    def __init__(self, database):
+        self.database = database  # AsyncDB
+        self._users = None  # login -> (login, passw, access, last_online)
+        self._basic = {}  # значение заголовка Authorization -> пользователь
+        self._version = 0  # номер сброса кэша
+
+    def invalidate(self):
+        """сбросить кэш после изменения таблицы users"""
+        self._users = None
+        self._basic = {}
+        self._version += 1
+
+    async def _load(self):
+        while self._users is None:
+            version = self._version
+            users = await self.database.read(db.registered_users)
+            if version != self._version:
+                continue  # кэш сброшен, пока шло чтение - прочитать заново
+            self._basic = {self.basic_header(user[0], user[1]): user for user in users}
+            self._users = {user[0]: user for user in users}
+        return self._users
+
+    @staticmethod
+    def basic_header(login, passw):
+        encoded_string = base64.b64encode(f'{login}:{passw}'.encode('utf-8')).decode('ascii')
+        return f'Basic {encoded_string}'
+
+    async def get(self, login):
+        """пользователь по логину: (login, passw, access, last_online), или None"""
+        return (await self._load()).get(login)
+
+    async def by_basic_auth(self, header):
+        """пользователь по значению заголовка Authorization, или None"""
+        await self._load()
+        return self._basic.get(header)
@@ -1,13 +1,59 @@
 import sqlite3
+import threading
 import time
 import base64
 
 
+DB_FILE = 'hosts.db'
+_local = threading.local()  # постоянное подключение к базе данных, своё у каждого потока
+
+
+class BatchConnection(sqlite3.Connection):
+    # подключение потока записи AsyncDB: пока batch == True, функции этого модуля
+    # выполняются внутри общей транзакции пачки, и их commit/rollback относятся
+    # к точке сохранения текущей функции, а не ко всей транзакции
+    batch = False
+
+    def commit(self):
+        if not self.batch:
+            super().commit()
+
+    def rollback(self):
+        if self.batch:
+            self.execute('ROLLBACK TO call')
+        else:
+            super().rollback()
+
+
+def connect(factory=sqlite3.Connection):
+    # постоянное подключение к базе данных, открывается один раз на поток.
+    # WAL журнал: commit не переписывает журнал отката и не делает fsync базы каждый раз,
+    # чтение не блокируется записью; запросы подготавливаются один раз и кэшируются
+    # подключением (cached_statements), пока оно открыто
+    base = getattr(_local, 'base', None)
+    if base is None:
+        base = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=256, factory=factory)
+        base.execute('PRAGMA journal_mode = WAL')
+        base.execute('PRAGMA synchronous = NORMAL')
+        base.execute('PRAGMA cache_size = -16384')  # 16 МБ
+        base.execute('PRAGMA temp_store = MEMORY')
+        _local.base = base
+    return base
+
+
+def close():
+    # закрыть подключение к базе данных текущего потока (при остановке сервера)
+    base = getattr(_local, 'base', None)
+    if base is not None:
+        base.close()
+        _local.base = None
+
+
 def init_db():
-    # подлкючение к базе данных и создание курсора
+    # подключение к базе данных и создание курсора
 
     try:
-        base = sqlite3.connect('hosts.db')
+        base = connect()
         cursor = base.cursor()
         return base, cursor
     except Exception:
@@ -19,7 +65,6 @@ def icmp_params():
     base, cursor = init_db()
     r = cursor.execute('''SELECT * FROM icmp_params''').fetchall()
     a, b, c, d, f, _ = r[0]
-    base.close()
     return a, b, c, d, f
 
 
@@ -52,10 +97,9 @@ def icmp_params_update(auto_ping=None,
                            (icmp_timeout, 'parametrs',))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -68,13 +112,12 @@ def insert_host(ip, name, folder_id, state, time, info, sms):
         base.commit()
     except sqlite3.IntegrityError:
         # исключение если пытаются добавить уже существующий хост
-        base.close()
+        base.rollback()
         return 'unique item error'
     except Exception:
-        base.close()
+        base.rollback()
         return 'unknown error'
 
-    base.close()
     return 'success'
 
 
@@ -86,10 +129,9 @@ def delete_host(ip_id):
         cursor.execute('''DELETE FROM servers WHERE ip == ?''', (ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение при возникновении ошибки
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -101,10 +143,9 @@ def change_folder(ip_id, data, search_folder=False):
         cursor.execute(f'''UPDATE servers SET folder == ? WHERE ip == ?''', (data, ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -116,10 +157,9 @@ def change_name(ip_id, data):
         cursor.execute(f'''UPDATE servers SET name == ? WHERE ip == ?''', (data, ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -131,10 +171,9 @@ def change_ip(ip_id, data):
         cursor.execute(f'''UPDATE servers SET ip == ? WHERE ip == ?''', (data, ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -146,10 +185,9 @@ def change_state(ip_id, data):
         cursor.execute(f'''UPDATE servers SET state == ? WHERE ip == ?''', (data, ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -161,10 +199,9 @@ def change_sms(ip_id, sms_state):
         cursor.execute(f'''UPDATE servers SET send_sms == ? WHERE ip == ?''', (sms_state, ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -176,10 +213,9 @@ def change_time(ip_id, data):
         cursor.execute(f'''UPDATE servers SET time == ? WHERE ip == ?''', (data, ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -191,20 +227,141 @@ def change_info(ip_id, data):
         cursor.execute(f'''UPDATE servers SET info == ? WHERE ip == ?''', (data, ip_id,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
+def update_hosts_state(rows):
+    # записать состояние и время изменения сразу нескольких хостов одной транзакцией
+    # rows: [(state, time, ip), ...]
+
+    base, cursor = init_db()
+    try:
+        cursor.executemany('''UPDATE servers SET state == ?, time == ? WHERE ip == ?''', rows)
+        base.commit()
+    except Exception:
+        base.rollback()
+        # исключение если возникла ошибка
+        return 'unknown error'
+    return 'success'
+
+
+def existing_hosts(cursor, ips):
+    # ip из списка, которые есть в таблице servers
+    # вернёт Set
+
+    ips = list(ips)
+    existing = set()
+    for i in range(0, len(ips), 500):
+        chunk = ips[i:i + 500]
+        marks = ', '.join('?' * len(chunk))
+        existing.update(row[0] for row in cursor.execute(f'''SELECT ip FROM servers WHERE ip IN ({marks})''', chunk))
+    return existing
+
+
+def insert_hosts(rows):
+    # добавить несколько хостов одной транзакцией
+    # rows: [(ip, name, folder_id, state, time, info, sms), ...]
+    # вернёт List результатов по строкам ('success', 'unique item error', 'folder not exists')
+    # или 'unknown error'
+
+    base, cursor = init_db()
+    try:
+        existing = existing_hosts(cursor, [row[0] for row in rows])
+        folders = {str(row[0]) for row in cursor.execute('''SELECT id FROM folders''')}
+        results, valid = [], []
+        for row in rows:
+            if row[0] in existing:
+                results.append('unique item error')
+            elif str(row[2]) not in folders:
+                results.append('folder not exists')
+            else:
+                existing.add(row[0])  # повтор ip в самом списке
+                valid.append(row)
+                results.append('success')
+        cursor.executemany('''INSERT INTO servers VALUES(?, ?, ?, ?, ?, ?, ?)''', valid)
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return results
+
+
+def change_folder_hosts(rows):
+    # поменять папку нескольких хостов одной транзакцией
+    # rows: [(folder_id, ip), ...]
+    # вернёт List результатов по строкам ('success', 'not found', 'folder not exists') или 'unknown error'
+
+    base, cursor = init_db()
+    try:
+        existing = existing_hosts(cursor, [row[1] for row in rows])
+        folders = {str(row[0]) for row in cursor.execute('''SELECT id FROM folders''')}
+        results, valid = [], []
+        for row in rows:
+            if row[1] not in existing:
+                results.append('not found')
+            elif str(row[0]) not in folders:
+                results.append('folder not exists')
+            else:
+                valid.append(row)
+                results.append('success')
+        cursor.executemany('''UPDATE servers SET folder == ? WHERE ip == ?''', valid)
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return results
+
+
+def change_state_hosts(rows):
+    # поменять состояние (пауза или снятие с паузы) нескольких хостов одной транзакцией
+    # rows: [(state, ip), ...]
+    # вернёт List результатов по строкам ('success', 'not found') или 'unknown error'
+
+    base, cursor = init_db()
+    try:
+        existing = existing_hosts(cursor, [row[1] for row in rows])
+        results = ['success' if row[1] in existing else 'not found' for row in rows]
+        cursor.executemany('''UPDATE servers SET state == ? WHERE ip == ?''',
+                           [row for row in rows if row[1] in existing])
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return results
+
+
+def delete_hosts(ips):
+    # удалить несколько хостов одной транзакцией
+    # вернёт List результатов по строкам ('success', 'not found') или 'unknown error'
+
+    base, cursor = init_db()
+    try:
+        existing = existing_hosts(cursor, ips)
+        results, valid = [], []
+        for ip in ips:
+            if ip in existing:
+                existing.discard(ip)  # повтор ip в самом списке
+                valid.append((ip,))
+                results.append('success')
+            else:
+                results.append('not found')
+        cursor.executemany('''DELETE FROM servers WHERE ip == ?''', valid)
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return results
+
+
 def all_info():
     # получить список всех хостов в базе
     # вернёт List
 
     base, cursor = init_db()
     r = cursor.execute('''SELECT * FROM servers ''').fetchall()
-    base.close()
     return r
 
 
@@ -219,7 +376,6 @@ def registered_users():
         _login = base64.b64decode(user[0]).decode('utf-8')
         _passw = base64.b64decode(user[1]).decode('utf-8')
         users.append((_login, _passw, user[2], user[3]))
-    base.close()
     return users
 
 
@@ -229,20 +385,186 @@ def phone_numbers():
 
     base, cursor = init_db()
     r = cursor.execute('''SELECT * FROM phones ''').fetchall()
-    base.close()
     return r
 
 
 def sms_api():
-    # получить список всех номеров SMS рассылки в базе
+    # получить настройки SMS шлюза
     # вернёт List
 
     base, cursor = init_db()
-    r = cursor.execute('''SELECT * FROM phones ''').fetchall()
-    base.close()
+    r = cursor.execute('''SELECT * FROM sms_api_data ''').fetchall()
+    return r
+
+
+def init_alerts():
+    # создать таблицу неотправленных оповещений, если её нет
+
+    base, cursor = init_db()
+    try:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS alerts (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              recipient TEXT,
+                              text TEXT,
+                              created INTEGER,
+                              attempts INTEGER,
+                              next_try INTEGER)''')
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return 'success'
+
+
+def pending_alerts():
+    # получить все неотправленные оповещения
+    # вернёт List: [(id, recipient, text, created, attempts, next_try), ...]
+
+    base, cursor = init_db()
+    try:
+        r = cursor.execute('''SELECT * FROM alerts ORDER BY id''').fetchall()
+    except Exception:
+        r = []
     return r
 
 
+def insert_alerts(rows):
+    # добавить оповещения одной транзакцией
+    # rows: [(recipient, text, created, attempts, next_try), ...]
+    # вернёт List id добавленных оповещений или 'unknown error'
+
+    base, cursor = init_db()
+    try:
+        ids = []
+        for row in rows:
+            cursor.execute('''INSERT INTO alerts (recipient, text, created, attempts, next_try)
+                              VALUES(?, ?, ?, ?, ?)''', row)
+            ids.append(cursor.lastrowid)
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return ids
+
+
+def update_alerts(rows):
+    # записать номер попытки и время следующей попытки отправки
+    # rows: [(attempts, next_try, id), ...]
+
+    base, cursor = init_db()
+    try:
+        cursor.executemany('''UPDATE alerts SET attempts == ?, next_try == ? WHERE id == ?''', rows)
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return 'success'
+
+
+def delete_alerts(ids):
+    # удалить отправленные (или устаревшие) оповещения
+
+    base, cursor = init_db()
+    try:
+        cursor.executemany('''DELETE FROM alerts WHERE id == ?''', [(i,) for i in ids])
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return 'success'
+
+
+def init_events():
+    # создать таблицу событий лога и её индексы, если их нет
+    # id растёт вместе со временем записи, поэтому выборки по индексам type/login/host
+    # сразу упорядочены по времени (в индекс неявно входит rowid)
+
+    base, cursor = init_db()
+    try:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS events (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              time REAL,
+                              type TEXT,
+                              login TEXT,
+                              host TEXT,
+                              message TEXT)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS events_time ON events (time)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS events_type ON events (type)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS events_login ON events (login)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS events_host ON events (host)''')
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return 'success'
+
+
+def insert_events(rows):
+    # добавить события лога одной транзакцией
+    # rows: [(time, type, login, host, message), ...]
+
+    base, cursor = init_db()
+    try:
+        cursor.executemany('''INSERT INTO events (time, type, login, host, message) VALUES(?, ?, ?, ?, ?)''', rows)
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return 'success'
+
+
+def delete_events(before):
+    # удалить события старше времени before
+
+    base, cursor = init_db()
+    try:
+        cursor.execute('''DELETE FROM events WHERE time < ?''', (before,))
+        base.commit()
+    except Exception:
+        base.rollback()
+        return 'unknown error'
+    return 'success'
+
+
+def query_events(since=None, until=None, type_=None, login=None, host=None, cursor_id=None, limit=100):
+    # события лога за период [since, until) с фильтрами, от новых к старым, не больше limit
+    # cursor_id - продолжить с события, id которого меньше (из предыдущей страницы)
+    # вернёт ([(id, time, type, login, host, message), ...], cursor_id следующей страницы или None)
+
+    base, cursor = init_db()
+    where, params = [], []
+    try:
+        # период переводится в границы id по индексу events_time
+        if since is not None:
+            first = cursor.execute('''SELECT id FROM events WHERE time >= ? ORDER BY time LIMIT 1''',
+                                   (since,)).fetchone()
+            if first is None:
+                return [], None
+            where.append('id >= ?')
+            params.append(first[0])
+        if until is not None:
+            last = cursor.execute('''SELECT id FROM events WHERE time < ? ORDER BY time DESC LIMIT 1''',
+                                  (until,)).fetchone()
+            if last is None:
+                return [], None
+            where.append('id <= ?')
+            params.append(last[0])
+        if cursor_id is not None:
+            where.append('id < ?')
+            params.append(cursor_id)
+        for column, value in (('type', type_), ('login', login), ('host', host)):
+            if value is not None:
+                where.append(f'{column} == ?')
+                params.append(value)
+        sql = '''SELECT * FROM events''' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY id DESC LIMIT ?'
+        r = cursor.execute(sql, (*params, limit + 1)).fetchall()
+    except Exception:
+        return [], None
+    if len(r) > limit:
+        return r[:limit], r[limit - 1][0]
+    return r, None
+
+
 def one_info(ip_id):
     # получить всю информацию о хосте по IP
     # если хост не найден, то вернёт 'not found'
@@ -251,14 +573,12 @@ def one_info(ip_id):
     try:
         recv = cursor.execute('''SELECT * FROM servers WHERE ip == ?''', (ip_id,)).fetchone()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
     if recv:
-        base.close()
         return recv
     else:
-        base.close()
         return 'not found'
 
 
@@ -270,10 +590,10 @@ def create_folder(id_folder, name_folder):
         cursor.execute('''INSERT INTO folders VALUES(?, ?)''', (id_folder, name_folder))
     except sqlite3.IntegrityError:
         # исключение если пытаются добавить уже существующую папку
-        base.close()
+        base.rollback()
         return 'unique item error'
     except Exception:
-        base.close()
+        base.rollback()
         return 'unknown error'
     base.commit()
     return 'success'
@@ -289,10 +609,10 @@ def create_user(login, passw, access):
         cursor.execute('''INSERT INTO users VALUES(?, ?, ?, ?)''', (encoded_login, encoded_passw, access, None))
     except sqlite3.IntegrityError:
         # исключение если пытаются добавить уже существующую папку
-        base.close()
+        base.rollback()
         return 'unique item error'
     except Exception:
-        base.close()
+        base.rollback()
         return 'unknown error'
     base.commit()
     return 'success'
@@ -306,10 +626,10 @@ def create_phone_number(number, info):
         cursor.execute('''INSERT INTO phones VALUES(?, ?)''', (number, info))
     except sqlite3.IntegrityError:
         # исключение если пытаются добавить уже существующую папку
-        base.close()
+        base.rollback()
         return 'unique item error'
     except Exception:
-        base.close()
+        base.rollback()
         return 'unknown error'
     base.commit()
     return 'success'
@@ -324,13 +644,11 @@ def delete_folder(id_folder):
             cursor.execute('''DELETE FROM folders WHERE id == ?''', (id_folder,))
             base.commit()
         else:
-            base.close()
             return 'folder not exists'
     except Exception:
-        base.close()
+        base.rollback()
         # исключение при возникновении ошибки
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -343,10 +661,9 @@ def delete_user(login):
         cursor.execute('''DELETE FROM users WHERE login == ?''', (login,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение при возникновении ошибки
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -358,10 +675,9 @@ def delete_phone(number):
         cursor.execute('''DELETE FROM phones WHERE number == ?''', (number,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение при возникновении ошибки
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -373,10 +689,9 @@ def change_id_folder(id_folder, new_id):
         cursor.execute(f'''UPDATE folders SET id == ? WHERE id == ?''', (new_id, id_folder,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -388,10 +703,9 @@ def change_name_folder(id_folder, new_name):
         cursor.execute(f'''UPDATE folders SET name == ? WHERE id == ?''', (new_name, id_folder,))
         base.commit()
     except Exception:
-        base.close()
+        base.rollback()
         # исключение если возникла ошибка
         return 'unknown error'
-    base.close()
     return 'success'
 
 
@@ -400,7 +714,6 @@ def load_folders():
 
     base, cursor = init_db()
     r = cursor.execute('''SELECT * FROM folders ''').fetchall()
-    base.close()
     return r
 
 
@@ -426,11 +739,17 @@ def check_folder_(id_folder):
 
 
 def change_folder_all_hosts(id_folder, new_id):
-    # поменять папку на хостах
+    # поменять папку на всех хостах папки (одним запросом)
 
-    for i in all_info():
-        if i[2] == id_folder:
-            change_folder(i[0], new_id)
+    base, cursor = init_db()
+    try:
+        cursor.execute('''UPDATE servers SET folder == ? WHERE folder == ?''', (new_id, id_folder,))
+        base.commit()
+    except Exception:
+        base.rollback()
+        # исключение если возникла ошибка
+        return 'unknown error'
+    return 'success'
 
 
 def change_last_online(login):
@@ -440,10 +759,10 @@ def change_last_online(login):
         cursor.execute('''UPDATE users SET last_online == ? WHERE login == ?''', (int(time.time()), login))
     except sqlite3.IntegrityError:
         # исключение если пытаются добавить уже существующую папку
-        base.close()
+        base.rollback()
         return 'unique item error'
     except Exception:
-        base.close()
+        base.rollback()
         return 'unknown error'
     base.commit()
     return 'success'
@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+
+class EventBatcher:
+    """
+    Накопление icmp событий для пакетной рассылки.
+
+    События копятся window сек. с первого события пачки (или до max_events событий)
+    и отправляются одним сообщением {'response': 34, 'data': [событие, ...]}:
+    один пакет протокола, одно сжатие и одна отправка на клиента вместо пакета на каждый хост.
+    Получают его только клиенты, включившие пакетный формат (SERVICE 85),
+    остальным события по-прежнему рассылаются по одному (response 33).
+    """
+
+    RESPONSE = 34
+
+    def __init__(self, send, window=0.2, max_events=500):
+        self.loop = asyncio.get_event_loop()
+        self.send = send  # функция рассылки готового сообщения (str)
+        self.window = window
+        self.max_events = max_events
+        self._events = []
+        self._timer = None
+        self.batches = 0  # отправлено пачек
+        self.events = 0  # отправлено событий
+
+    def add(self, event):
+        self._events.append(event)
+        if len(self._events) >= self.max_events:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.window, self.flush)
+
+    def flush(self):
+        """отправить накопленные события"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._events:
+            return
+        events, self._events = self._events, []
+        self.batches += 1
+        self.events += len(events)
+        self.send(json.dumps({'response': self.RESPONSE, 'data': events}))
+
+    def stats(self):
+        return {'window': self.window, 'max_events': self.max_events, 'pending': len(self._events),
+                'batches': self.batches, 'events': self.events}
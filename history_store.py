@@ -0,0 +1,296 @@
+import asyncio
+import concurrent.futures
+import math
+import mmap
+import os
+import socket
+import struct
+import time
+import hashlib
+
+_NAME_KEY = 1 << 63  # признак ключа не IPv4 хоста
+
+
+def host_key(ip):
+    """
+    ключ хоста в истории: IPv4 адрес числом (меньше 2**32), для остальных адресов
+    (IPv6, имена) - 63 бита хеша строки с установленным старшим битом,
+    такие ключи не пересекаются с IPv4 адресами
+    """
+    try:
+        return struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+    except (OSError, TypeError):
+        digest = hashlib.blake2b(ip.encode('utf-8'), digest_size=8).digest()
+        return _NAME_KEY | int.from_bytes(digest, 'big')
+
+
+class HistoryStore:
+    """
+    История проверок хостов на диске.
+
+    Сырые результаты проверок дописываются записями фиксированной длины
+    в сегменты по 5 минут (history/raw). Фоновая задача сворачивает закрытые сегменты
+    в агрегаты по минутам (history/minute), минуты - в часы (history/hour),
+    часы - в сутки (history/day). В файлах агрегатов записи отсортированы по (хост, время),
+    поэтому запрос по одному хосту - это двоичный поиск в файле через mmap,
+    и вопрос "RTT/потери хоста за 30 дней" читает около 30 суточных записей,
+    не трогая сырые данные.
+
+    Старые файлы каждого уровня удаляются по сроку хранения.
+    Границы часов и суток считаются по UTC.
+    """
+
+    # время, хост, средний RTT в мс (NaN - нет ответа), потери %, отправлено icmp
+    RAW = struct.Struct('<IQfBB2x')
+    # начало периода, хост, проверок, ответивших, сумма RTT, мин. RTT, макс. RTT, сумма потерь %
+    ROLLUP = struct.Struct('<IQIIdffI')
+    # расширения файлов: сырые сегменты, агрегаты; файлы прежнего формата (32-битный ключ)
+    # не читаются и удаляются по сроку хранения
+    _EXT = {'raw': 'rec', 'rollup': 'agg'}
+    _LEGACY_EXT = ('seg', 'roll')
+
+    _SEGMENT = 300  # длина сырого сегмента, сек.
+    # уровень: (длина периода агрегата, длина периода одного файла, уровень-источник)
+    _LEVELS = {
+        'minute': (60, _SEGMENT, 'raw'),
+        'hour': (3600, 3600, 'minute'),
+        'day': (86400, 86400, 'hour'),
+    }
+    _RETENTION = {'minute': 7 * 86400, 'hour': 90 * 86400, 'day': 730 * 86400}  # сек.
+    _GRACE = 10  # сегмент считается закрытым спустя столько сек. после окончания
+    _FLUSH_INTERVAL = 2
+    _ROLLUP_INTERVAL = 60
+
+    def __init__(self, path='history', raw_days=2):
+        self.loop = asyncio.get_event_loop()
+        self.path = path
+        self.raw_retention = raw_days * 86400
+        self._buffers = {}  # начало сегмента -> bytearray ещё не записанных сырых записей
+        # свои потоки для запросов: долгий запрос не задерживает запись истории и отдачу файлов
+        self._queries = concurrent.futures.ThreadPoolExecutor(2, thread_name_prefix='history-query')
+        for level in ('raw', 'minute', 'hour', 'day'):
+            os.makedirs(os.path.join(path, level), exist_ok=True)
+
+    def _file(self, level, start):
+        ext = self._EXT['raw' if level == 'raw' else 'rollup']
+        return os.path.join(self.path, level, f'{start}.{ext}')
+
+    def _starts(self, level, extensions=None):
+        # начала периодов всех файлов уровня
+        extensions = extensions or tuple(self._EXT.values())
+        starts = []
+        for name in os.listdir(os.path.join(self.path, level)):
+            stem, _, ext = name.partition('.')
+            if stem.isdigit() and ext in extensions:
+                starts.append(int(stem))
+        return sorted(starts)
+
+    def add(self, ip, host, ts=None):
+        """записать результат проверки (icmplib.Host)"""
+        ts = int(ts or time.time())
+        segment = ts - ts % self._SEGMENT
+        buffer = self._buffers.get(segment)
+        if buffer is None:
+            buffer = self._buffers[segment] = bytearray()
+        buffer += self.RAW.pack(ts, host_key(ip),
+                                host.avg_rtt if host.is_alive else math.nan,
+                                int(round(host.packet_loss * 100)),
+                                min(host.packets_sent, 255))
+
+    def take_buffers(self):
+        """забрать накопленные записи (вызывается из цикла событий)"""
+        buffers, self._buffers = self._buffers, {}
+        return buffers
+
+    def flush(self, buffers=None):
+        """дописать накопленные записи в сырые сегменты"""
+        if buffers is None:
+            buffers = self.take_buffers()
+        for segment, data in buffers.items():
+            with open(self._file('raw', segment), 'ab') as file:
+                file.write(data)
+
+    async def run(self):
+        # фоновая запись сегментов и свёртка агрегатов, файловые операции - в потоке
+        last_rollup = 0
+        while True:
+            await asyncio.sleep(self._FLUSH_INTERVAL)
+            try:
+                await self.loop.run_in_executor(None, self.flush, self.take_buffers())
+                if time.time() - last_rollup >= self._ROLLUP_INTERVAL:
+                    last_rollup = time.time()
+                    await self.loop.run_in_executor(None, self.rollup)
+            except (Exception,):
+                pass
+
+    # --- свёртка ---
+
+    def rollup(self, now=None):
+        """построить недостающие агрегаты закрытых периодов и удалить устаревшие файлы"""
+        now = int(now or time.time())
+        for level in ('minute', 'hour', 'day'):
+            _, file_span, source = self._LEVELS[level]
+            done = set(self._starts(level))
+            pending = {}  # начало периода -> файлы уровня-источника
+            for start in self._starts(source):
+                period = start - start % file_span
+                pending.setdefault(period, []).append(start)
+            for period, sources in pending.items():
+                if period in done or period + file_span + self._GRACE > now:
+                    continue
+                self._build(level, period, source, sources)
+        self._purge(now)
+
+    def _build(self, level, period, source, sources):
+        bucket = self._LEVELS[level][0]
+        groups = {}  # (хост, начало периода агрегата) -> [проверок, ответивших, сумма, мин, макс, потери]
+        for start in sources:
+            for record in self._read_all(source, start):
+                if source == 'raw':
+                    ts, key, rtt, loss, _ = record
+                    replied = 0 if math.isnan(rtt) else 1
+                    record = (ts, key, 1, replied, rtt if replied else 0.0,
+                              rtt if replied else 0.0, rtt if replied else 0.0, loss)
+                self._merge(groups, (record[1], record[0] - record[0] % bucket), record)
+
+        tmp = self._file(level, period) + '.tmp'
+        with open(tmp, 'wb') as file:
+            for (key, ts), agg in sorted(groups.items()):
+                file.write(self.ROLLUP.pack(ts, key, *agg))
+        os.replace(tmp, self._file(level, period))
+
+    @staticmethod
+    def _merge(groups, group, record):
+        _, _, samples, replied, rtt_sum, rtt_min, rtt_max, loss = record
+        agg = groups.get(group)
+        if agg is None:
+            groups[group] = [samples, replied, rtt_sum, rtt_min, rtt_max, loss]
+            return
+        if replied:
+            if agg[1]:
+                agg[3] = min(agg[3], rtt_min)
+                agg[4] = max(agg[4], rtt_max)
+            else:
+                agg[3], agg[4] = rtt_min, rtt_max
+        agg[0] += samples
+        agg[1] += replied
+        agg[2] += rtt_sum
+        agg[5] += loss
+
+    def _read_all(self, level, start):
+        record_struct = self.RAW if level == 'raw' else self.ROLLUP
+        try:
+            with open(self._file(level, start), 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                size -= size % record_struct.size  # недописанная запись в конце игнорируется
+                if not size:
+                    return []
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return list(record_struct.iter_unpack(data[:size]))
+        except OSError:
+            return []
+
+    def _purge(self, now):
+        for level in ('raw', 'minute', 'hour', 'day'):
+            retention = self.raw_retention if level == 'raw' else self._RETENTION[level]
+            file_span = self._SEGMENT if level == 'raw' else self._LEVELS[level][1]
+            for start in self._starts(level):
+                if start + file_span < now - retention:
+                    try:
+                        os.remove(self._file(level, start))
+                    except OSError:
+                        pass
+            for start in self._starts(level, self._LEGACY_EXT):
+                if start + file_span < now - retention:
+                    for ext in self._LEGACY_EXT:
+                        try:
+                            os.remove(os.path.join(self.path, level, f'{start}.{ext}'))
+                        except OSError:
+                            pass
+
+    # --- чтение ---
+
+    def _lookup(self, level, start, key):
+        # двоичный поиск записей хоста в файле агрегатов
+        try:
+            with open(self._file(level, start), 'rb') as file:
+                count = os.fstat(file.fileno()).st_size // self.ROLLUP.size
+                if not count:
+                    return []
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    size = self.ROLLUP.size
+                    low, high = 0, count
+                    while low < high:
+                        middle = (low + high) // 2
+                        if struct.unpack_from('<Q', data, middle * size + 4)[0] < key:
+                            low = middle + 1
+                        else:
+                            high = middle
+                    records = []
+                    while low < count:
+                        record = self.ROLLUP.unpack_from(data, low * size)
+                        if record[1] != key:
+                            break
+                        records.append(record)
+                        low += 1
+                    return records
+        except OSError:
+            return
+
+    def _period_records(self, level, period, key):
+        # агрегаты хоста за период одного файла; если файла ещё нет (период не закрыт) -
+        # собираются из более мелких агрегатов
+        records = self._lookup(level, period, key)
+        if records is not None:
+            return records
+        source = self._LEVELS[level][2]
+        file_span = self._LEVELS[level][1]
+        if source == 'raw' or period + file_span < time.time() - 2 * (self._ROLLUP_INTERVAL + self._GRACE):
+            # последние минуты ещё не свёрнуты, а для давно закрытого периода без файла данных нет
+            return []
+        bucket = self._LEVELS[level][0]
+        source_span = self._LEVELS[source][1]
+        groups = {}
+        for start in range(period, period + file_span, source_span):
+            if start > time.time():
+                break
+            for record in self._period_records(source, start, key):
+                self._merge(groups, record[0] - record[0] % bucket, record)
+        return [(ts, key, *agg) for ts, agg in sorted(groups.items())]
+
+    def query(self, ip, since, until, step=None):
+        """
+        RTT/потери хоста за период [since, until).
+        step - 'minute', 'hour' или 'day', по умолчанию выбирается по длине периода.
+        Период обрезается сроком хранения агрегатов step (раньше данных нет) и текущим временем;
+        ValueError, если since/until не конечные числа.
+        """
+        if not (math.isfinite(since) and math.isfinite(until)):
+            raise ValueError('since/until')
+        since, until = int(since), int(until)
+        if step not in self._LEVELS:
+            span = until - since
+            step = 'minute' if span <= 7200 else 'hour' if span <= 3 * 86400 else 'day'
+        bucket, file_span, _ = self._LEVELS[step]
+        now = int(time.time())
+        since = max(since, now - self._RETENTION[step] - file_span)
+        until = min(until, now + file_span)
+        key = host_key(ip)
+        points = []
+        for period in range(since - since % file_span, until, file_span):
+            for ts, _, samples, replied, rtt_sum, rtt_min, rtt_max, loss in self._period_records(step, period, key):
+                if ts + bucket <= since or ts >= until:
+                    continue
+                points.append({
+                    'ts': ts,
+                    'samples': samples,
+                    'loss': round(loss / samples, 2) if samples else None,
+                    'rtt_avg': round(rtt_sum / replied, 3) if replied else None,
+                    'rtt_min': round(rtt_min, 3) if replied else None,
+                    'rtt_max': round(rtt_max, 3) if replied else None,
+                })
+        return {'ip': ip, 'step': step, 'points': points}
+
+    async def query_async(self, ip, since, until, step=None):
+        """query в потоке: чтение файлов агрегатов не блокирует цикл событий"""
+        return await self.loop.run_in_executor(self._queries, self.query, ip, since, until, step)
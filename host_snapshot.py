@@ -0,0 +1,62 @@
+import json
+import time
+
+
+class HostSnapshot:
+    """
+    Готовые ответы со списками хостов: all, dead, live, pause и хосты папки.
+
+    Ответ хранится уже сериализованным: JSON список хостов (для HTTP) и сжатый пакет
+    протокола с {'response': 200, 'data': список} (для TCP клиентов).
+    Строится из таблицы хостов в памяти при первом запросе после изменения её ревизии,
+    повторные запросы без изменений отдают готовые байты без SQLite и json.dumps.
+
+    Изменения хостов от клиентов видны в ответе сразу. Состояния, которые пингер
+    меняет непрерывно, попадают в ответ не позже чем через max_age сек. - как и раньше,
+    когда списки читались из БД, куда состояния пишутся раз в StateFlushInterval.
+    """
+
+    _STATES = {'dead': ('offline', 'clock.offline'), 'live': ('online', 'clock.online'), 'pause': ('pause',)}
+    _MAX_VIEWS = 256
+
+    def __init__(self, hosts, protocol, max_age=2):
+        self.hosts = hosts  # HostTable
+        self.protocol = protocol
+        self.max_age = max_age
+        self._views = {}  # вид -> [ревизия, время построения, JSON списка, пакет протокола или None]
+        self.builds = 0
+        self.hits = 0
+
+    def _rows(self, view):
+        if view == 'all':
+            return self.hosts.rows()
+        if view in self._STATES:
+            return self.hosts.in_states(self._STATES[view])
+        return self.hosts.in_folder(view[1])  # ('folder', id папки)
+
+    def _view(self, view):
+        entry = self._views.get(view)
+        revision = self.hosts.revision
+        if entry is not None and (entry[0] == revision or (
+                entry[0] >= self.hosts.edit_revision and time.monotonic() - entry[1] < self.max_age)):
+            self.hits += 1
+            return entry
+        if len(self._views) >= self._MAX_VIEWS:
+            self._views.clear()
+        entry = self._views[view] = [revision, time.monotonic(), json.dumps(self._rows(view)).encode('utf-8'), None]
+        self.builds += 1
+        return entry
+
+    def data(self, view):
+        """JSON список хостов вида: 'all', 'dead', 'live', 'pause' или ('folder', id папки)"""
+        return self._view(view)[2]
+
+    def frame(self, view):
+        """пакет протокола с ответом {'response': 200, 'data': список хостов вида}"""
+        entry = self._view(view)
+        if entry[3] is None:
+            entry[3] = self.protocol.pack(b'{"response": 200, "data": ' + entry[2] + b'}')
+        return entry[3]
+
+    def stats(self):
+        return {'revision': self.hosts.revision, 'views': len(self._views), 'builds': self.builds, 'hits': self.hits}
@@ -0,0 +1,279 @@
+import asyncio
+import itertools
+import time
+import db
+from ip_index import IPIndex
+
+
+class HostTable:
+    """
+    Таблица хостов в памяти.
+
+    Загружается из БД при старте сервера и является основным источником данных для пингера:
+    результаты проверок меняют только её, без обращения к SQLite на каждый хост.
+    Изменённые state/time раз в flush_interval сек. записываются в таблицу servers
+    одной транзакцией, и только для тех хостов, у которых они действительно поменялись.
+
+    Запись идёт через поток записи AsyncDB (database), не блокируя цикл событий;
+    синхронный flush - только для остановки сервера.
+
+    Изменения хостов от клиентов (добавление, удаление, редактирование) по-прежнему
+    пишутся в БД сразу, а в таблицу переносятся методами add/remove/apply/rename.
+
+    Адреса хостов дополнительно проиндексированы числами (IPIndex) для выборок
+    по подсети и началу адреса, а также множествами ip по состоянию и по папке:
+    список недоступных хостов или хостов папки не перебирает всю таблицу.
+
+    Любое изменение таблицы увеличивает номер ревизии (revision), изменение от клиентов -
+    ещё и edit_revision: по ним HostSnapshot решает, когда перестроить готовые ответы.
+
+    Журнал изменений хранит для каждого изменённого или удалённого хоста ревизию его
+    последнего изменения (не больше journal_size записей, старые вытесняются).
+    По нему changes(since) отдаёт клиенту только хосты, изменившиеся после его ревизии.
+    Пометка проверки (online -> clock.online -> online) в журнал не попадает:
+    для синхронизации clock.online - это online, clock.offline - offline (sync_rows),
+    иначе каждая проверка попадала бы в изменения всех проверенных хостов.
+    Ревизия начинается с текущего времени в мкс, поэтому после перезапуска сервера
+    она больше любой выданной раньше, и клиент со старой ревизией получит полный список.
+    """
+
+    _FIELDS = {'ip': 0, 'name': 1, 'folder': 2, 'state': 3, 'time': 4, 'info': 5, 'sms': 6}
+
+    def __init__(self, flush_interval=2, database=None, journal_size=100000):
+        self.loop = asyncio.get_event_loop()
+        self.flush_interval = flush_interval
+        self.database = database  # AsyncDB
+        self._rows = {}  # ip -> [ip, name, folder, state, time, info, send_sms]
+        self._dirty = set()  # ip хостов, состояние которых ещё не записано в БД
+        self.index = IPIndex()  # адреса хостов числами
+        self._by_state = {}  # состояние -> множество ip
+        self._by_folder = {}  # папка (строкой) -> множество ip
+        self._order = {}  # ip -> порядковый номер хоста в таблице (порядок rows())
+        self._sequence = itertools.count()
+        self.revision = time.time_ns() // 1000  # номер последнего изменения таблицы
+        self.edit_revision = 0  # номер последнего изменения от клиентов
+        self.journal_size = journal_size
+        self._journal = {}  # ip -> ревизия последнего изменения, по возрастанию ревизий
+        self._horizon = self.revision  # изменения до этой ревизии в журнале уже не полны
+
+    def load(self):
+        """загрузить все хосты из БД"""
+        self._rows = {row[0]: list(row) for row in db.all_info()}
+        self._dirty.clear()
+        self.index.load(self._rows)
+        self._by_state.clear()
+        self._by_folder.clear()
+        self._order.clear()
+        for row in self._rows.values():
+            self._order[row[0]] = next(self._sequence)
+            self._group_add(row)
+        self._edited()
+        self._journal.clear()
+        self._horizon = self.revision
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, ip):
+        return ip in self._rows
+
+    def get(self, ip):
+        """строка хоста в формате db.one_info, или None"""
+        row = self._rows.get(ip)
+        if row is None:
+            return
+        return tuple(row)
+
+    def rows(self):
+        """все хосты в формате db.all_info"""
+        return [tuple(row) for row in self._rows.values()]
+
+    def in_states(self, states):
+        """хосты в состояниях states, в порядке rows()"""
+        ips = set()
+        for state in states:
+            ips |= self._by_state.get(state, set())
+        return self._rows_of(ips)
+
+    def in_folder(self, folder):
+        """хосты папки, в порядке rows()"""
+        return self._rows_of(self._by_folder.get(str(folder), ()))
+
+    def _rows_of(self, ips):
+        return [tuple(self._rows[ip]) for ip in sorted(ips, key=self._order.__getitem__)]
+
+    def _group_add(self, row):
+        self._by_state.setdefault(row[3], set()).add(row[0])
+        self._by_folder.setdefault(str(row[2]), set()).add(row[0])
+
+    def _group_remove(self, row):
+        for groups, key in ((self._by_state, row[3]), (self._by_folder, str(row[2]))):
+            ips = groups.get(key)
+            if ips is not None:
+                ips.discard(row[0])
+                if not ips:
+                    del groups[key]
+
+    def in_network(self, cidr):
+        """хосты подсети ('10.20.0.0/16') по возрастанию адреса, ValueError если cidr не подсеть"""
+        return [tuple(self._rows[ip]) for ip in self.index.in_network(cidr)]
+
+    def search(self, prefix):
+        """хосты, IPv4 адрес которых начинается с prefix ('10.20.'), по возрастанию адреса"""
+        return [tuple(self._rows[ip]) for ip in self.index.search(prefix)]
+
+    def changes(self, since):
+        """
+        изменения после ревизии since: (ревизия, изменённые и добавленные хосты, удалённые ip),
+        или None, если журнал их уже не содержит - нужен полный список хостов
+        """
+        revision = self.revision
+        if since < self._horizon or since > revision:
+            return
+        updated, deleted = [], []
+        for ip in reversed(self._journal):
+            if self._journal[ip] <= since:
+                break
+            row = self._rows.get(ip)
+            if row is None:
+                deleted.append(ip)
+            else:
+                updated.append(self._sync_row(row))
+        return revision, updated, deleted
+
+    def sync_rows(self):
+        """все хосты для синхронизации клиента: как rows(), но без пометки проверки clock.*"""
+        return [self._sync_row(row) for row in self._rows.values()]
+
+    @staticmethod
+    def _sync_state(state):
+        return state[6:] if state.startswith('clock.') else state
+
+    def _sync_row(self, row):
+        return (row[0], row[1], row[2], self._sync_state(row[3]), *row[4:])
+
+    def _journal_add(self, ip):
+        # записать изменение хоста в журнал, самое старое вытесняется при переполнении
+        self._journal.pop(ip, None)
+        self._journal[ip] = self.revision
+        if len(self._journal) > self.journal_size:
+            oldest = next(iter(self._journal))
+            self._horizon = self._journal.pop(oldest)
+
+    def set_state(self, ip, state, change_time=None):
+        """изменить состояние (и время изменения) хоста, в БД попадёт при следующей записи"""
+        row = self._rows.get(ip)
+        if row is None:
+            return
+        if row[3] == state and (change_time is None or row[4] == change_time):
+            return
+        visible = self._sync_state(row[3]) != self._sync_state(state) or (
+            change_time is not None and row[4] != change_time)
+        if row[3] != state:
+            self._group_remove(row)
+            row[3] = state
+            self._group_add(row)
+        if change_time is not None:
+            row[4] = change_time
+        self._dirty.add(ip)
+        self.revision += 1
+        if visible:
+            self._journal_add(ip)
+
+    def _edited(self):
+        self.revision += 1
+        self.edit_revision = self.revision
+
+    def add(self, row):
+        old = self._rows.get(row[0])
+        if old is None:
+            self.index.add(row[0])
+            self._order[row[0]] = next(self._sequence)
+        else:
+            self._group_remove(old)
+        self._rows[row[0]] = list(row)
+        self._group_add(self._rows[row[0]])
+        self._edited()
+        self._journal_add(row[0])
+
+    def remove(self, ip):
+        row = self._rows.pop(ip, None)
+        if row is not None:
+            self.index.remove(ip)
+            self._group_remove(row)
+            del self._order[ip]
+            self._edited()
+            self._journal_add(ip)
+        self._dirty.discard(ip)
+
+    def apply(self, ip, **fields):
+        """перенести в таблицу изменения полей хоста, уже записанные в БД"""
+        row = self._rows.get(ip)
+        if row is None:
+            return
+        self._group_remove(row)
+        for field, value in fields.items():
+            row[self._FIELDS[field]] = value
+        self._group_add(row)
+        self._edited()
+        self._journal_add(ip)
+
+    def rename(self, ip, new_ip):
+        row = self._rows.pop(ip, None)
+        if row is None:
+            return
+        self._group_remove(row)
+        del self._order[ip]
+        row[0] = new_ip
+        self.index.remove(ip)
+        replaced = self._rows.pop(new_ip, None)
+        if replaced is None:
+            self.index.add(new_ip)
+        else:
+            self._group_remove(replaced)
+        self._rows[new_ip] = row
+        self._order[new_ip] = next(self._sequence)
+        self._group_add(row)
+        self._edited()
+        self._journal_add(ip)
+        self._journal_add(new_ip)
+        if ip in self._dirty:
+            self._dirty.discard(ip)
+            self._dirty.add(new_ip)
+
+    def _take_changes(self):
+        # забрать изменённые хосты: (ip, строки для db.update_hosts_state)
+        dirty, self._dirty = self._dirty, set()
+        rows = []
+        for ip in dirty:
+            row = self._rows.get(ip)
+            if row is not None:
+                rows.append((row[3], row[4], ip))
+        return dirty, rows
+
+    def _check_result(self, dirty, result):
+        if result != 'success':
+            # не удалось - попробовать при следующей записи
+            self._dirty |= dirty
+
+    def flush(self):
+        """записать накопившиеся изменения состояний в БД одной транзакцией (синхронно)"""
+        if not self._dirty:
+            return 'success'
+        dirty, rows = self._take_changes()
+        result = db.update_hosts_state(rows)
+        self._check_result(dirty, result)
+        return result
+
+    async def run_flusher(self):
+        # фоновая запись изменений в БД через поток записи
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if not self._dirty:
+                continue
+            dirty, rows = self._take_changes()
+            try:
+                result = await self.database.write(db.update_hosts_state, rows)
+            except (Exception,):
+                result = 'unknown error'
+            self._check_result(dirty, result)
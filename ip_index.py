@@ -0,0 +1,107 @@
+import array
+import bisect
+import ipaddress
+import socket
+import struct
+
+
+class IPIndex:
+    """
+    Индекс адресов хостов для выборок по подсети и по началу адреса.
+
+    Адреса хранятся числами в отсортированных массивах (IPv4 - array 'I' по 4 байта,
+    IPv6 - список int), рядом - строки адресов в том же порядке.
+    Выборка подсети (CIDR) - это двоичный поиск границ диапазона [первый адрес, последний адрес],
+    поиск по началу IPv4 адреса ('10.20.', '192.168.1') сводится к не более чем трём
+    таким диапазонам. Строки, которые не являются IP адресом (имена хостов), в индекс не попадают.
+    """
+
+    def __init__(self):
+        self._keys = {4: array.array('I'), 6: []}  # версия -> адреса числами по возрастанию
+        self._ips = {4: [], 6: []}  # версия -> строки адресов в том же порядке
+
+    def __len__(self):
+        return len(self._ips[4]) + len(self._ips[6])
+
+    @staticmethod
+    def _parse(ip):
+        # (версия, адрес числом) или None
+        try:
+            return 4, struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+        except (OSError, TypeError):
+            pass
+        try:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+        except (OSError, TypeError):
+            return
+
+    def load(self, ips):
+        """построить индекс заново по списку адресов"""
+        parsed = {4: [], 6: []}
+        for ip in ips:
+            key = self._parse(ip)
+            if key is not None:
+                parsed[key[0]].append((key[1], ip))
+        for version, items in parsed.items():
+            items.sort()
+            self._keys[version] = array.array('I', (n for n, _ in items)) if version == 4 else [n for n, _ in items]
+            self._ips[version] = [ip for _, ip in items]
+
+    def add(self, ip):
+        key = self._parse(ip)
+        if key is None:
+            return
+        version, n = key
+        position = bisect.bisect_right(self._keys[version], n)
+        self._keys[version].insert(position, n)
+        self._ips[version].insert(position, ip)
+
+    def remove(self, ip):
+        key = self._parse(ip)
+        if key is None:
+            return
+        version, n = key
+        keys, ips = self._keys[version], self._ips[version]
+        position = bisect.bisect_left(keys, n)
+        while position < len(keys) and keys[position] == n:
+            if ips[position] == ip:
+                del keys[position]
+                del ips[position]
+                return
+            position += 1
+
+    def _range(self, version, first, last):
+        keys = self._keys[version]
+        return self._ips[version][bisect.bisect_left(keys, first):bisect.bisect_right(keys, last)]
+
+    def in_network(self, cidr):
+        """адреса подсети по возрастанию, cidr - '10.20.0.0/16' (или один адрес); ValueError если не подсеть"""
+        network = ipaddress.ip_network(cidr, strict=False)
+        return self._range(network.version, int(network.network_address), int(network.broadcast_address))
+
+    def search(self, prefix):
+        """IPv4 адреса, начинающиеся с prefix ('10.20.', '192.168.1'), по возрастанию; ValueError если не начало адреса"""
+        parts = prefix.split('.')
+        if len(parts) > 4 or not all(part.isdigit() for part in parts[:-1]) or not (parts[-1].isdigit() or not parts[-1]):
+            raise ValueError(prefix)
+        if any(part != str(int(part)) for part in parts if part) or any(int(part) > 255 for part in parts if part):
+            return []  # в записи адреса не бывает ведущих нулей и октетов больше 255
+        fixed = [int(part) for part in parts[:-1]]
+        shift = 8 * (3 - len(fixed))
+        base = sum(octet << 8 * (3 - i) for i, octet in enumerate(fixed))
+
+        # значения последнего (неполного) октета, запись которых начинается с его цифр
+        last = parts[-1]
+        if not last:
+            octets = [(0, 255)]
+        elif last == '0':
+            octets = [(0, 0)]
+        else:
+            value = int(last)
+            octets = [(value, value)]
+            octets += [(low, min(low + step - 1, 255)) for low, step in ((value * 10, 10), (value * 100, 100))
+                       if low <= 255]
+        ips = []
+        for low, high in octets:
+            ips += self._range(4, base + (low << shift), base + ((high + 1) << shift) - 1)
+        return ips
@@ -1,6 +1,8 @@
 import json
-import base64
+import math
 import os
+import time
+from urllib.parse import parse_qs
 from micro_async_http.base_request_handler import AsyncSimpleHTTPRequestHandler
 import db
 
@@ -28,52 +30,115 @@ class HTTPRequestHandler(AsyncSimpleHTTPRequestHandler):
             ('/api/hosts/dead', self.hosts_DEAD),
             ('/api/hosts/live', self.hosts_LIVE),
             ('/api/hosts/pause', self.hosts_PAUSE),
+            ('/api/hosts/subnet', self.hosts_SUBNET),
+            ('/api/hosts/search', self.hosts_SEARCH),
+            ('/api/hosts/changes', self.hosts_CHANGES),
+            ('/api/logs', self.logs_QUERY),
+            ('/api/hosts/<ip>/stats', self.host_STATS),
+            ('/api/hosts/<ip>/history', self.host_HISTORY),
         )
 
-    def check_ALL(self):
+    async def check_ALL(self):
         """потокобезопастный вызов в цикле asyncio пинга"""
-        self.stream_server.pinger.start_ping_all()
-        self.send_response_json('Ping checking ALL started...')
+        status = self.stream_server.pinger.start_ping_all()
+        if status == 'started':
+            self.send_response_json('Ping checking ALL started...')
+        elif status == 'queued':
+            self.send_response_json('Ping checking ALL queued after current check...')
+        else:
+            self.send_response_json('Ping checking ALL already in progress...')
         self.stream_server.log.user_event(self.user_login, self.user_access, '', '[Web] запустил проверку всех хостов')
 
-    def check_DEAD(self):
+    async def check_DEAD(self):
         """потокобезопастный вызов в цикле asyncio пинга"""
-        self.stream_server.pinger.start_ping_dead()
-        self.send_response_json('Ping checking DEAD started...')
+        status = self.stream_server.pinger.start_ping_dead()
+        self.send_response_json(f'Ping checking DEAD started... (new: {status["started"]}, '
+                                f'already in progress: {status["merged"]})')
 
         self.stream_server.log.user_event(self.user_login, self.user_access, '', '[Web] запустил проверку недоступных хостов')
 
-    def hosts_ALL(self):
-        """отправить из БД список всех хостов"""
-        self.send_response_json(db.all_info())
-
-    def hosts_DEAD(self):
-        """отправить из БД список мертвых хостов"""
-        hosts = []
-        for host in db.all_info():
-            if host[3] == 'clock.offline' or host[3] == 'offline':
-                hosts.append(host)
-        self.send_response_json(hosts)
-
-    def hosts_LIVE(self):
-        """отправить из БД список живых хостов"""
-        hosts = []
-        for host in db.all_info():
-            if host[3] == 'clock.online' or host[3] == 'online':
-                hosts.append(host)
-        self.send_response_json(hosts)
-
-    def hosts_PAUSE(self):
-        """отправить из БД список хостов на паузе"""
-        hosts = []
-        for host in db.all_info():
-            if host[3] == 'pause':
-                hosts.append(host)
-        self.send_response_json(hosts)
+    async def hosts_ALL(self):
+        """отправить список всех хостов"""
+        self.send_response_json(self.stream_server.snapshot.data('all'))
+
+    async def hosts_DEAD(self):
+        """отправить список мертвых хостов"""
+        self.send_response_json(self.stream_server.snapshot.data('dead'))
+
+    async def hosts_LIVE(self):
+        """отправить список живых хостов"""
+        self.send_response_json(self.stream_server.snapshot.data('live'))
+
+    async def hosts_PAUSE(self):
+        """отправить список хостов на паузе"""
+        self.send_response_json(self.stream_server.snapshot.data('pause'))
+
+    async def hosts_SUBNET(self):
+        """отправить список хостов подсети, параметры: ?cidr=10.20.0.0/16"""
+        try:
+            self.send_response_json(self.stream_server.hosts.in_network(self.query_params()['cidr']))
+        except (KeyError, ValueError):
+            self.send_error(400)
+
+    async def hosts_SEARCH(self):
+        """отправить список хостов по началу IPv4 адреса, параметры: ?prefix=10.20."""
+        try:
+            self.send_response_json(self.stream_server.hosts.search(self.query_params()['prefix']))
+        except (KeyError, ValueError):
+            self.send_error(400)
+
+    async def hosts_CHANGES(self):
+        """отправить изменения хостов после ревизии, параметры: ?since=ревизия (0 - все хосты)"""
+        try:
+            self.send_response_json(self.stream_server.host_changes(int(self.query_params().get('since', 0))))
+        except ValueError:
+            self.send_error(400)
+
+    async def logs_QUERY(self):
+        """отправить события лога, параметры: ?since=&until=&type=&login=&host=&cursor=&limit="""
+        params = self.query_params()
+        try:
+            since = float(params['since']) if 'since' in params else None
+            until = float(params['until']) if 'until' in params else None
+            cursor_id = int(params['cursor']) if 'cursor' in params else None
+            limit = max(min(int(params.get('limit', 100)), 1000), 1)
+        except ValueError:
+            self.send_error(400)
+            return
+        events, cursor_id = await self.stream_server.db.read(
+            db.query_events, since, until, params.get('type'), params.get('login'), params.get('host'), cursor_id, limit)
+        self.send_response_json({'events': events, 'cursor': cursor_id})
+
+    async def host_STATS(self, ip):
+        """отправить RTT/jitter/потери хоста за последние проверки"""
+        stats = self.stream_server.probe_stats.summary(ip)
+        if stats is None:
+            self.send_error(404)
+        else:
+            self.send_response_json(stats)
+
+    async def host_HISTORY(self, ip):
+        """отправить историю RTT/потерь хоста, параметры: ?days=30&step=day"""
+        params = self.query_params()
+        try:
+            days = float(params.get('days', 1))
+        except ValueError:
+            days = 0
+        if not (math.isfinite(days) and days > 0):
+            self.send_error(400)
+            return
+        until = time.time()
+        self.send_response_json(await self.stream_server.history.query_async(ip, until - days * 86400, until,
+                                                                             params.get('step')))
+
+    def query_params(self):
+        """параметры из строки запроса"""
+        query = self.path.split('?', 1)[1] if '?' in self.path else ''
+        return {name: values[0] for name, values in parse_qs(query).items()}
 
     def send_response_json(self, obj):
-        """отправка response 200, c JSON строкой"""
-        json_obj = json.dumps(obj).encode('utf-8')
+        """отправка response 200, c JSON строкой (obj - объект, или уже готовый JSON в bytes)"""
+        json_obj = obj if isinstance(obj, bytes) else json.dumps(obj).encode('utf-8')
         self.send_response(200)
         self.send_header('Content-Type', 'application/json; charset=utf-8')
         self.send_header('Content-Lenght', str(len(json_obj)))
@@ -83,34 +148,32 @@ class HTTPRequestHandler(AsyncSimpleHTTPRequestHandler):
         self.end_headers()
         self.send_data(json_obj)
 
-    def is_authorized(self):
+    async def is_authorized(self):
         """Проверка авторизации"""
         auth_header = self.headers.get('Authorization')
         if not auth_header:
             self.send_error(401)  # response Not Authorized
         else:
-            for user in db.registered_users():
+            user = await self.stream_server.users.by_basic_auth(auth_header)
+            if user is not None:
                 login = user[0]
-                passw = user[1]
                 self.user_login = user[0]
                 self.user_access = user[2]
-                encoded_string = base64.b64encode(f'{login}:{passw}'.encode('utf-8')).decode('ascii')
-                if auth_header == f'Basic {encoded_string}':
-                    # пользователь авторизовался
-                    if login in self.stream_server.temp_users_web:
-                        self.stream_server.temp_users_web[login] = 60 * 15  # через сколько сек. завершать условную сессию
-                    else:
-                        self.stream_server.temp_users_web[login] = 60 * 15
-                        self.loop.create_task(self.stream_server.loop_timer_web(login))
-                        self.stream_server.log.user_event(login=login,
-                                       access=user[2],
-                                       ip='',
-                                       msg=f'[Web] подключился к серверу {self.client_address}')
-
-                        # изменение даты последнего посещения в БД
-                        db.change_last_online(login)
+                # пользователь авторизовался
+                if login in self.stream_server.temp_users_web:
+                    self.stream_server.temp_users_web[login] = 60 * 15  # через сколько сек. завершать условную сессию
+                else:
+                    self.stream_server.temp_users_web[login] = 60 * 15
+                    self.loop.create_task(self.stream_server.loop_timer_web(login))
+                    self.stream_server.log.user_event(login=login,
+                                   access=user[2],
+                                   ip='',
+                                   msg=f'[Web] подключился к серверу {self.client_address}')
 
-                    return True
+                    # изменение даты последнего посещения в БД
+                    self.stream_server.db.write(db.change_last_online, login)
+
+                return True
             self.send_error(401)  # response Not Authorized
 
     def access_file(self):
@@ -130,15 +193,33 @@ class HTTPRequestHandler(AsyncSimpleHTTPRequestHandler):
         except (OSError, Exception):
             self.send_error(500)
 
-    def access_api(self):
+    async def access_api(self):
 
         if '/api' in self.path:
             for path, method in self.api_routes:
-                if self.path.split('?')[0] == path:
-                    method()
+                params = self.match_route(path, self.path.split('?')[0])
+                if params is not None:
+                    await method(*params)
                     return True
             self.send_error(404)
 
+    @staticmethod
+    def match_route(route, path):
+        """сравнить путь с маршрутом, вернёт значения параметров вида <ip> или None"""
+        route_parts = route.split('/')
+        path_parts = path.split('/')
+        if len(route_parts) != len(path_parts):
+            return
+        params = []
+        for route_part, path_part in zip(route_parts, path_parts):
+            if route_part.startswith('<') and route_part.endswith('>'):
+                if not path_part:
+                    return
+                params.append(path_part)
+            elif route_part != path_part:
+                return
+        return params
+
     def do_FOUND(self, redirect_path):
         self.send_response(302, msg='Found')
         self.send_header('Location', redirect_path)
@@ -149,7 +230,7 @@ class HTTPRequestHandler(AsyncSimpleHTTPRequestHandler):
     async def do_GET(self):
 
         # проверка авторизации
-        if not self.is_authorized():
+        if not await self.is_authorized():
             return
 
         # выход из учётной записи
@@ -158,7 +239,7 @@ class HTTPRequestHandler(AsyncSimpleHTTPRequestHandler):
             return
 
         # проверка доступа к API методу и его вызов
-        if self.access_api():
+        if await self.access_api():
             return
 
         # redirect на главную страницу
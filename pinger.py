@@ -1,8 +1,842 @@
-from icmplib import async_ping
+from icmplib import async_ping, Host
 import asyncio
+import collections
+import ctypes
+import heapq
+import itertools
+import math
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import threading
 import time
-import db
 import json
+import zlib
+
+
+class ICMPEngine:
+    """
+    Движок массовой ICMP проверки хостов.
+
+    Вместо отдельного async_ping (а значит и отдельного сокета с таймерами) на каждый хост,
+    движок держит небольшой фиксированный набор ICMP сокетов, рассылает через них
+    echo request сразу для множества хостов и раскладывает ответы по хостам,
+    сопоставляя их по адресу отправителя, identifier и sequence.
+
+    Во время проверки в памяти находятся только хосты, от которых ещё ожидаются ответы,
+    поэтому расход памяти не зависит от размера списка хостов.
+    """
+
+    _SOCKETS = 2  # кол-во ICMP сокетов движка
+    _RCVBUF = 4 * 1024 * 1024  # буфер приёма ОС, чтобы пачка ответов не терялась
+    _RECV_BATCH = 1024  # максимум пакетов, вычитываемых из сокета за один вызов
+    _MAX_BURST = 256  # максимум новых хостов за одну итерацию цикла отправки
+    _PAYLOAD = b'icmp pinger server'.ljust(56, b'\x00')
+    _ECHO_REQUEST = 8
+    _ECHO_REPLY = 0
+
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self._socks = []  # (socket, identifier, raw)
+        self._pending = {}  # (ip, sequence) -> (probe, время отправки)
+        self._deadlines = []  # heap: (время истечения timeout, (ip, sequence))
+        self._reaper = None
+        self._seq = 0
+        self._batches = set()  # выполняющиеся ping_many
+        self.bucket = TokenBucket(rate=100)
+        self._meter = RateMeter()
+        words = self._PAYLOAD + b'\x00' * (len(self._PAYLOAD) % 2)
+        self._payload_sum = sum(struct.unpack(f'!{len(words) // 2}H', words))
+
+    def _open_sockets(self):
+        # сокеты открываются при первой проверке, а не при создании движка
+        for i in range(self._SOCKETS):
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+                raw = True
+            except PermissionError:
+                # без прав root используется datagram ICMP сокет (identifier выставляет ядро)
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+                raw = False
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._RCVBUF)
+            except OSError:
+                pass
+            identifier = (os.getpid() * self._SOCKETS + i) & 0xffff
+            if raw:
+                self._attach_filter(sock, identifier)
+            self._socks.append((sock, identifier, raw))
+            self.loop.add_reader(sock.fileno(), self._on_readable, sock, identifier, raw)
+
+    @staticmethod
+    def _attach_filter(sock, identifier):
+        """
+        BPF фильтр для raw сокета (только Linux): ядро отдаёт сокету только echo reply
+        с его identifier. Без фильтра каждый raw сокет получает копию всех ICMP пакетов системы,
+        и при нескольких сокетах/процессах каждый из них разбирал бы чужие ответы.
+        """
+        if not sys.platform.startswith('linux'):
+            return
+        program = (
+            (0xb1, 0, 0, 0),  # ldxb 4*([0]&0xf) - длина IP заголовка
+            (0x50, 0, 0, 0),  # ldb [x+0] - ICMP type
+            (0x15, 0, 3, 0),  # jeq #0 (echo reply), иначе - отбросить
+            (0x48, 0, 0, 4),  # ldh [x+4] - identifier
+            (0x15, 0, 1, identifier),  # jeq #identifier, иначе - отбросить
+            (0x06, 0, 0, 0x40000),  # ret - принять пакет
+            (0x06, 0, 0, 0),  # ret - отбросить
+        )
+        instructions = ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *i) for i in program))
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, 26,  # SO_ATTACH_FILTER
+                            struct.pack('HL', len(program), ctypes.addressof(instructions)))
+        except OSError:
+            pass
+
+    def _packet(self, identifier, sequence):
+        # контрольная сумма payload посчитана заранее, досчитывается только заголовок
+        checksum = self._payload_sum + (self._ECHO_REQUEST << 8) + identifier + sequence
+        while checksum >> 16:
+            checksum = (checksum & 0xffff) + (checksum >> 16)
+        header = struct.pack('!2B3H', self._ECHO_REQUEST, 0, ~checksum & 0xffff, identifier, sequence)
+        return header + self._PAYLOAD
+
+    async def ping(self, ip, count=3, interval=1, timeout=1):
+        """пинг одного хоста вне очереди (без ограничения скорости), вернёт icmplib.Host"""
+        result = []
+        await self.ping_many((ip,), lambda _, host: result.append(host), count, interval, timeout, paced=False)
+        return result[0]
+
+    async def ping_many(self, addresses, on_result, count=3, interval=1, timeout=1, paced=True, total=None):
+        """
+        Пинг множества хостов через общие сокеты движка.
+
+        - addresses: итерируемый объект с IP, читается по мере отправки
+        - on_result: callback(ip, icmplib.Host), вызывается как только по хосту
+          получены все ответы или истёк timeout
+        - paced: запуск новых хостов ограничивается общим TokenBucket движка
+        - total: кол-во хостов в addresses, если известно (для статистики очереди)
+
+        Корутина завершается, когда по всем хостам получен результат.
+        """
+        if not self._socks:
+            self._open_sockets()
+
+        batch = _Batch(on_result, count, interval, timeout, self.loop.create_future())
+        batch.backlog = total or 0
+        self._batches.add(batch)
+        resend = collections.deque()  # (время, probe) - очередь следующих echo, упорядочена по времени
+        addresses = iter(addresses)
+
+        try:
+            while True:
+                now = self.loop.time()
+                while resend and resend[0][0] <= now:
+                    self._send(resend.popleft()[1], resend)
+
+                if addresses is not None:
+                    # новые хосты запускаются пачкой - сколько токенов накопилось с прошлого раза
+                    burst = self.bucket.take(self._MAX_BURST) if paced else self._MAX_BURST
+                    started = 0
+                    for _ in range(burst):
+                        ip = next(addresses, None)
+                        if ip is None:
+                            addresses = None
+                            break
+                        self._start(ip, batch, resend)
+                        started += 1
+                    batch.backlog = max(batch.backlog - started, 0)
+                    self._meter.add(started)
+                    if addresses is None:
+                        continue
+                    wait = self.bucket.delay() if paced else 0
+                    if resend:
+                        wait = min(wait, resend[0][0] - now)
+                    await asyncio.sleep(wait)  # при wait == 0 просто отдать управление циклу событий
+                elif resend:
+                    await asyncio.sleep(resend[0][0] - now)
+                else:
+                    break
+
+            batch.exhausted = True
+            if batch.active:
+                await batch.done
+        finally:
+            self._batches.discard(batch)
+
+    def set_rate(self, rate):
+        """ограничение скорости запуска новых хостов (хостов в секунду)"""
+        self.bucket.set_rate(rate)
+
+    def stats(self):
+        """статистика отправки: заданная и фактическая скорость, очередь"""
+        return {
+            'rate_limit': self.bucket.rate,
+            'achieved_rate': round(self._meter.rate(), 1),
+            'backlog': sum(batch.backlog for batch in self._batches),
+            'in_flight': len(self._pending),
+        }
+
+    def _start(self, ip, batch, resend):
+        batch.active += 1
+        try:
+            socket.inet_pton(socket.AF_INET, ip)
+        except (OSError, TypeError):
+            # доменные имена и IPv6 проверяются по старинке, через icmplib
+            self.loop.create_task(self._fallback_ping(ip, batch))
+            return
+        self._send(_Probe(ip, batch), resend)
+
+    async def _fallback_ping(self, ip, batch):
+        try:
+            host = await async_ping(ip, count=batch.count, interval=batch.interval, timeout=batch.timeout)
+        except (Exception,):
+            host = Host(ip, batch.count, [])
+        self._deliver(batch, ip, host)
+
+    def _send(self, probe, resend):
+        batch = probe.batch
+        self._seq = (self._seq + 1) & 0xffff
+        sock, identifier, _ = self._socks[self._seq % len(self._socks)]
+        probe.sent += 1
+        now = self.loop.time()
+        try:
+            sock.sendto(self._packet(identifier, self._seq), (probe.ip, 0))
+        except OSError:
+            # хост недоступен на уровне сети (нет маршрута, переполнен буфер) - считаем потерей
+            pass
+        else:
+            key = (probe.ip, self._seq)
+            self._pending[key] = (probe, now)
+            probe.outstanding += 1
+            deadline = now + batch.timeout
+            heapq.heappush(self._deadlines, (deadline, key))
+            if self._reaper is None or self._reaper.when() > deadline:
+                self._arm_reaper()
+
+        if probe.sent < batch.count:
+            resend.append((now + batch.interval, probe))
+        elif not probe.outstanding:
+            self._deliver(batch, probe.ip, Host(probe.ip, probe.sent, probe.rtts))
+
+    def _on_readable(self, sock, identifier, raw):
+        # разбор всех накопившихся в сокете ответов
+        pending = self._pending
+        for _ in range(self._RECV_BATCH):
+            try:
+                packet, addr = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            now = self.loop.time()
+            offset = (packet[0] & 0x0f) << 2 if raw else 0  # raw сокет отдаёт пакет вместе с IP заголовком
+            if len(packet) < offset + 8 or packet[offset] != self._ECHO_REPLY:
+                continue
+            reply_id, sequence = struct.unpack_from('!2H', packet, offset + 4)
+            if raw and reply_id != identifier:
+                continue  # ответ на чужой пинг
+            entry = pending.pop((addr[0], sequence), None)
+            if entry is None:
+                continue  # опоздавший ответ или дубликат
+            probe, sent_time = entry
+            probe.rtts.append((now - sent_time) * 1000)
+            probe.outstanding -= 1
+            if not probe.outstanding and probe.sent >= probe.batch.count:
+                self._deliver(probe.batch, probe.ip, Host(probe.ip, probe.sent, probe.rtts))
+
+    def _arm_reaper(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        self._reaper = self.loop.call_at(self._deadlines[0][0], self._reap) if self._deadlines else None
+
+    def _reap(self):
+        # echo без ответа по истечении timeout считаются потерянными
+        now = self.loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, key = heapq.heappop(self._deadlines)
+            entry = self._pending.pop(key, None)
+            if entry is None:
+                continue
+            probe = entry[0]
+            probe.outstanding -= 1
+            if not probe.outstanding and probe.sent >= probe.batch.count:
+                self._deliver(probe.batch, probe.ip, Host(probe.ip, probe.sent, probe.rtts))
+        self._reaper = None
+        self._arm_reaper()
+
+    @staticmethod
+    def _deliver(batch, ip, host):
+        batch.active -= 1
+        try:
+            batch.on_result(ip, host)
+        except (Exception,):
+            pass
+        if batch.exhausted and not batch.active and not batch.done.done():
+            batch.done.set_result(None)
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости на монотонных часах.
+
+    Токены копятся со скоростью rate в секунду, но не больше burst.
+    Отправитель забирает сразу все накопившиеся токены и запускает хосты пачкой,
+    поэтому задержки цикла событий не копятся между отправками (как было со sleep(1 / rate)),
+    а фактическая скорость совпадает с заданной даже при тысячах хостов в секунду.
+    """
+
+    _BURST_SECONDS = 0.05  # запас токенов, не больше 50 мс работы на заданной скорости
+
+    def __init__(self, rate):
+        self.rate = 0
+        self.burst = 1
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = max(float(rate), 1.0)
+        self.burst = max(self.rate * self._BURST_SECONDS, 1.0)
+        self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._stamp) * self.rate, self.burst)
+        self._stamp = now
+
+    def take(self, limit):
+        """забрать до limit токенов, вернёт сколько удалось"""
+        self._refill()
+        count = min(int(self._tokens), limit)
+        self._tokens -= count
+        return count
+
+    def delay(self):
+        """сколько секунд ждать до появления следующего токена"""
+        return max(1 - self._tokens, 0) / self.rate
+
+
+class RateMeter:
+    """скользящий счётчик событий в секунду за последние несколько секунд"""
+
+    def __init__(self, window=5):
+        self._window = window
+        self._slots = collections.deque()  # [секунда, кол-во]
+
+    def add(self, count):
+        second = int(time.monotonic())
+        if self._slots and self._slots[-1][0] == second:
+            self._slots[-1][1] += count
+        else:
+            self._slots.append([second, count])
+        while self._slots[0][0] <= second - self._window:
+            self._slots.popleft()
+
+    def rate(self):
+        now = time.monotonic()
+        while self._slots and self._slots[0][0] <= int(now) - self._window:
+            self._slots.popleft()
+        if not self._slots:
+            return 0.0
+        return sum(slot[1] for slot in self._slots) / max(now - self._slots[0][0], 1.0)
+
+
+class ShardedEngine:
+    """
+    ICMPEngine в нескольких процессах.
+
+    Хосты распределяются по процессам-обработчикам по crc32 адреса (хост всегда попадает
+    в один и тот же процесс). У каждого процесса свой цикл событий и свои ICMP сокеты,
+    задания и результаты передаются через pipe пачками. Основной процесс только
+    раздаёт хосты с общим ограничением скорости (TokenBucket) и обрабатывает результаты,
+    поэтому icmp нагрузка масштабируется по ядрам и не влияет на обслуживание клиентов.
+
+    Интерфейс совпадает с ICMPEngine.
+    """
+
+    _MAX_BURST = 1024  # максимум хостов за одну раздачу
+
+    def __init__(self, workers, rate=100):
+        self.loop = asyncio.get_event_loop()
+        self.workers = workers
+        self.bucket = TokenBucket(rate=rate)
+        self._meter = RateMeter()
+        self._procs = [None] * workers  # (процесс, pipe заданий, pipe результатов)
+        self._assigned = [{} for _ in range(workers)]  # по процессам: (batch id, ip) -> batch
+        self._batches = set()
+        self._ids = itertools.count()
+
+    def _spawn(self, index):
+        context = multiprocessing.get_context('spawn')
+        commands_recv, commands_send = context.Pipe(duplex=False)
+        results_recv, results_send = context.Pipe(duplex=False)
+        process = context.Process(target=_engine_worker, args=(commands_recv, results_send), daemon=True)
+        process.start()
+        commands_recv.close()
+        results_send.close()
+        self._procs[index] = (process, commands_send, results_recv)
+        self.loop.add_reader(results_recv.fileno(), self._on_results, index)
+
+    def _dispatch(self, index, batch, ips):
+        if self._procs[index] is None:
+            self._spawn(index)
+        assigned = self._assigned[index]
+        for ip in ips:
+            assigned[(batch.id, ip)] = batch
+        batch.active += len(ips)
+        try:
+            self._procs[index][1].send((batch.id, ips, batch.count, batch.interval, batch.timeout))
+        except OSError:
+            self._worker_died(index)
+
+    async def ping(self, ip, count=3, interval=1, timeout=1):
+        result = []
+        await self.ping_many((ip,), lambda _, host: result.append(host), count, interval, timeout, paced=False)
+        return result[0] if result else Host(ip, count, [])
+
+    async def ping_many(self, addresses, on_result, count=3, interval=1, timeout=1, paced=True, total=None):
+        """то же, что ICMPEngine.ping_many, но echo отправляют процессы-обработчики"""
+        batch = _Batch(on_result, count, interval, timeout, self.loop.create_future())
+        batch.id = next(self._ids)
+        batch.backlog = total or 0
+        self._batches.add(batch)
+        addresses = iter(addresses)
+        try:
+            while addresses is not None:
+                burst = self.bucket.take(self._MAX_BURST) if paced else self._MAX_BURST
+                shards = [[] for _ in range(self.workers)]
+                started = 0
+                for _ in range(burst):
+                    ip = next(addresses, None)
+                    if ip is None:
+                        addresses = None
+                        break
+                    shards[zlib.crc32(ip.encode('utf-8')) % self.workers].append(ip)
+                    started += 1
+                for index, ips in enumerate(shards):
+                    if ips:
+                        self._dispatch(index, batch, ips)
+                batch.backlog = max(batch.backlog - started, 0)
+                self._meter.add(started)
+                if addresses is not None:
+                    await asyncio.sleep(self.bucket.delay() if paced else 0)
+
+            batch.exhausted = True
+            if batch.active:
+                await batch.done
+        finally:
+            self._batches.discard(batch)
+
+    def _on_results(self, index):
+        process, _, results = self._procs[index]
+        assigned = self._assigned[index]
+        try:
+            while results.poll():
+                for batch_id, ip, packets_sent, rtts in results.recv():
+                    batch = assigned.pop((batch_id, ip), None)
+                    if batch is not None:
+                        ICMPEngine._deliver(batch, ip, Host(ip, packets_sent, rtts))
+        except (EOFError, OSError):
+            self._worker_died(index)
+
+    def _worker_died(self, index):
+        # хосты упавшего процесса снимаются с проверки без результата (вызывающий вернёт
+        # им прежнее состояние и расписание), процесс будет запущен заново при следующей раздаче
+        process, commands, results = self._procs[index]
+        self._procs[index] = None
+        self.loop.remove_reader(results.fileno())
+        for conn in (commands, results):
+            conn.close()
+        if process.is_alive():
+            process.kill()
+        assigned, self._assigned[index] = self._assigned[index], {}
+        for batch in assigned.values():
+            batch.active -= 1
+            if batch.exhausted and not batch.active and not batch.done.done():
+                batch.done.set_result(None)
+
+    def set_rate(self, rate):
+        self.bucket.set_rate(rate)
+
+    def stats(self):
+        return {
+            'rate_limit': self.bucket.rate,
+            'achieved_rate': round(self._meter.rate(), 1),
+            'backlog': sum(batch.backlog for batch in self._batches),
+            'in_flight': sum(len(assigned) for assigned in self._assigned),
+            'workers': self.workers,
+            'workers_alive': sum(1 for proc in self._procs if proc is not None and proc[0].is_alive()),
+        }
+
+
+def _engine_worker(commands, results):
+    """точка входа процесса-обработчика ShardedEngine"""
+    try:
+        asyncio.run(_EngineWorker.main(commands, results))
+    except KeyboardInterrupt:
+        pass
+
+
+class _EngineWorker:
+    """процесс-обработчик: пингует полученные хосты своим ICMPEngine и отправляет результаты пачками"""
+
+    _FLUSH_INTERVAL = 0.02
+    _FLUSH_SIZE = 512
+
+    def __init__(self, commands, results):
+        self.loop = asyncio.get_event_loop()
+        self.commands = commands
+        self.results = results
+        self.engine = ICMPEngine()
+        self._out = []
+
+    @classmethod
+    async def main(cls, commands, results):
+        await cls(commands, results).run()
+
+    async def run(self):
+        queue = asyncio.Queue()
+        # задания читаются в отдельном потоке, чтобы отправка результатов
+        # и приём заданий не могли заблокировать друг друга
+        threading.Thread(target=self._read_commands, args=(queue,), daemon=True).start()
+        self.loop.create_task(self._flusher())
+        while True:
+            command = await queue.get()
+            if command is None:
+                return  # основной процесс завершился
+            batch_id, ips, count, interval, timeout = command
+            self.loop.create_task(self.engine.ping_many(
+                ips, lambda ip, host, batch_id=batch_id: self._collect(batch_id, ip, host),
+                count, interval, timeout, paced=False))
+
+    def _read_commands(self, queue):
+        while True:
+            try:
+                command = self.commands.recv()
+            except (EOFError, OSError):
+                command = None
+            self.loop.call_soon_threadsafe(queue.put_nowait, command)
+            if command is None:
+                return
+
+    def _collect(self, batch_id, ip, host):
+        self._out.append((batch_id, ip, host.packets_sent, host.rtts))
+        if len(self._out) >= self._FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._out:
+            out, self._out = self._out, []
+            try:
+                self.results.send(out)
+            except OSError:
+                os._exit(0)  # основной процесс завершился
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self._FLUSH_INTERVAL)
+            self._flush()
+
+
+class SweepCoordinator:
+    """
+    Координатор полных проверок всех хостов.
+
+    Одновременно выполняется не больше одной полной проверки.
+    Запрос на проверку во время выполняющейся:
+    - объединяется с ней, если она ещё не начала рассылку icmp
+      (или уже запланирована повторная проверка);
+    - иначе ставит в очередь одну повторную проверку, сколько бы запросов ни пришло.
+    Плановая проверка по таймеру всегда объединяется с выполняющейся.
+    """
+
+    def __init__(self, pinger):
+        self.pinger = pinger
+        self.loop = pinger.loop
+        self._task = None
+        self._dispatching = False  # проверка уже рассылает icmp
+        self._followup = False  # запланирована повторная проверка
+        self.merged = 0  # кол-во запросов, объединённых с уже идущей проверкой
+        self.started = None
+        self.finished = None
+        self.duration = None
+        self.hosts = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def request(self, manual=False, show_alarm=False):
+        """запрос полной проверки, вернёт 'started', 'merged' или 'queued'"""
+        if not self.running:
+            self._task = self.loop.create_task(self._run(show_alarm))
+            return 'started'
+        if not manual or not self._dispatching or self._followup:
+            self.merged += 1
+            return 'merged'
+        self._followup = True
+        return 'queued'
+
+    async def run(self, show_alarm=False):
+        """запросить проверку и дождаться окончания выполняющейся"""
+        self.request(show_alarm=show_alarm)
+        await asyncio.shield(self._task)
+
+    async def _run(self, show_alarm):
+        log = self.pinger.parent_server.log
+        try:
+            while True:
+                self._dispatching = False
+                if show_alarm:
+                    log.alarm('Через 10 секунд начнётся плановая проверка всех хостов')
+                    await asyncio.sleep(10)
+                self._dispatching = True
+                self.started = time.time()
+                self.finished = None
+                try:
+                    self.hosts = await self.pinger._ping_all()
+                except (Exception,):
+                    self.hosts = 0
+                self.finished = time.time()
+                self.duration = round(self.finished - self.started, 3)
+                log.alarm(f'Проверка всех хостов завершена: {self.hosts} хостов за {self.duration} сек')
+                if not self._followup:
+                    break
+                self._followup = False
+                show_alarm = False
+        finally:
+            self._dispatching = False
+            self._followup = False
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'followup': self._followup,
+            'merged': self.merged,
+            'started': self.started,
+            'finished': self.finished,
+            'duration': self.duration,
+            'hosts': self.hosts,
+        }
+
+
+class ProbeScheduler:
+    """
+    Расписание проверок каждого хоста: heap по времени следующей проверки.
+
+    - хосты, которые недавно сменили состояние или застряли в clock.online/clock.offline,
+      проверяются чаще (fast = base / 4, но не реже base);
+    - после каждой проверки без смены состояния интервал удваивается,
+      но не больше ceiling.
+    Стабильные хосты тратят меньше icmp, а отключения ловятся быстрее там, где это важно.
+    """
+
+    _FAST_DIVIDER = 4
+    _MIN_FAST = 5  # сек.
+
+    def __init__(self, base=60, ceiling=600):
+        self._heap = []  # (время проверки, ip), устаревшие записи пропускаются при извлечении
+        self._hosts = {}  # ip -> [время проверки (None - проверяется сейчас), интервал]
+        self.set_intervals(base, ceiling)
+
+    def set_intervals(self, base, ceiling):
+        self.base = max(base, 1)
+        self.ceiling = max(ceiling, self.base)
+        self.fast = max(self.base / self._FAST_DIVIDER, min(self._MIN_FAST, self.base))
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def sync(self, hosts, now):
+        """сверить расписание со списком хостов: новые добавить, удалённые и на паузе убрать"""
+        active = set()
+        new = []
+        for host in hosts:
+            if host[3] == 'pause':
+                continue
+            active.add(host[0])
+            if host[0] not in self._hosts:
+                new.append(host)
+        for ip in [ip for ip in self._hosts if ip not in active]:
+            del self._hosts[ip]
+
+        # новые хосты равномерно распределяются по базовому интервалу, чтобы не было всплеска
+        spread = self.base / max(len(new), 1)
+        for i, host in enumerate(new):
+            if host[3].startswith('clock.'):
+                self._push(host[0], now, self.fast)
+            else:
+                self._push(host[0], now + i * spread, self.base)
+
+    def _push(self, ip, due, interval):
+        self._hosts[ip] = [due, interval]
+        heapq.heappush(self._heap, (due, ip))
+
+    def _is_stale(self, item):
+        entry = self._hosts.get(item[1])
+        return entry is None or entry[0] != item[0]
+
+    def pop_due(self, now):
+        """забрать хосты, которым пора на проверку"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            item = heapq.heappop(self._heap)
+            if self._is_stale(item):
+                continue
+            self._hosts[item[1]][0] = None
+            due.append(item[1])
+        return due
+
+    def next_due(self):
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def update(self, ip, changed, now):
+        """перепланировать хост по результату проверки"""
+        entry = self._hosts.get(ip)
+        if changed or entry is None:
+            interval = self.fast
+        else:
+            interval = min(entry[1] * 2, self.ceiling)
+        self._push(ip, now + interval, interval)
+
+    def discard(self, ip):
+        self._hosts.pop(ip, None)
+
+    def stats(self):
+        fast = backed_off = 0
+        for _, interval in self._hosts.values():
+            if interval < self.base:
+                fast += 1
+            elif interval > self.base:
+                backed_off += 1
+        return {
+            'hosts': len(self._hosts),
+            'fast': fast,
+            'backed_off': backed_off,
+            'base_interval': self.base,
+            'max_interval': self.ceiling,
+        }
+
+
+class ConfirmationQueue:
+    """
+    Очередь дополнительной проверки отключившихся хостов перед SMS оповещением (double_check).
+
+    Хосты группируются по секунде, в которую подходит срок проверки (delay сек. после отключения);
+    все хосты, срок которых подошёл, перепроверяются одним вызовом движка,
+    и подтверждённые оповещения отправляются одним проходом.
+    Хост, который включился раньше срока проверки, убирается из очереди.
+    """
+
+    def __init__(self, delay=30):
+        self.delay = delay
+        self._groups = {}  # секунда проверки -> {ip: (url, текст оповещения, время отключения)}
+        self._heap = []  # секунды, для которых есть группы
+        self._hosts = {}  # ip -> секунда проверки
+        self._batches = 0
+        self._confirmed = 0
+        self._cancelled = 0
+        self._latency_last = None
+        self._latency_max = 0
+        self._latency_sum = 0
+        self._latency_count = 0
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def add(self, ip, url, text, now):
+        if ip in self._hosts:
+            return
+        second = math.ceil(now + self.delay)
+        group = self._groups.get(second)
+        if group is None:
+            group = self._groups[second] = {}
+            heapq.heappush(self._heap, second)
+        group[ip] = (url, text, now)
+        self._hosts[ip] = second
+
+    def discard(self, ip):
+        """хост включился до проверки"""
+        second = self._hosts.pop(ip, None)
+        if second is not None:
+            del self._groups[second][ip]
+            self._cancelled += 1
+
+    def next_due(self):
+        while self._heap and not self._groups.get(self._heap[0]):
+            self._groups.pop(heapq.heappop(self._heap), None)
+        return self._heap[0] if self._heap else None
+
+    def pop_due(self, now):
+        """забрать все хосты, которым пора на проверку: {ip: (url, текст, время отключения)}"""
+        due = {}
+        while self._heap and self._heap[0] <= now:
+            group = self._groups.pop(heapq.heappop(self._heap), {})
+            due.update(group)
+        for ip in due:
+            del self._hosts[ip]
+        if due:
+            self._batches += 1
+        return due
+
+    def finished(self, confirmed, cancelled, now):
+        """учёт результата проверки пачки; confirmed - времена отключения подтверждённых хостов"""
+        self._cancelled += cancelled
+        self._confirmed += len(confirmed)
+        for offline_time in confirmed:
+            latency = now - offline_time
+            self._latency_last = latency
+            self._latency_max = max(self._latency_max, latency)
+            self._latency_sum += latency
+            self._latency_count += 1
+
+    def stats(self):
+        return {
+            'depth': len(self._hosts),
+            'groups': sum(1 for group in self._groups.values() if group),
+            'delay': self.delay,
+            'batches': self._batches,
+            'confirmed': self._confirmed,
+            'cancelled': self._cancelled,
+            'latency_last': None if self._latency_last is None else round(self._latency_last, 2),
+            'latency_avg': round(self._latency_sum / self._latency_count, 2) if self._latency_count else None,
+            'latency_max': round(self._latency_max, 2),
+        }
+
+
+class _Batch:
+    """параметры и счётчики одного вызова ICMPEngine.ping_many"""
+    __slots__ = ('on_result', 'count', 'interval', 'timeout', 'done', 'active', 'exhausted', 'backlog', 'id')
+
+    def __init__(self, on_result, count, interval, timeout, done):
+        self.on_result = on_result
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.done = done
+        self.active = 0  # хосты, по которым ещё нет результата
+        self.exhausted = False  # все хосты из addresses запущены
+        self.backlog = 0  # хосты, ещё ожидающие отправки
+        self.id = None  # номер пачки в ShardedEngine
+
+
+class _Probe:
+    """состояние проверки одного хоста"""
+    __slots__ = ('ip', 'batch', 'sent', 'outstanding', 'rtts')
+
+    def __init__(self, ip, batch):
+        self.ip = ip
+        self.batch = batch
+        self.sent = 0
+        self.outstanding = 0
+        self.rtts = []
 
 
 class Pinger:
@@ -16,6 +850,8 @@ class Pinger:
     - изменть кол-во отправленных icmp на один хост (по умолчанию - 3)
     - изменть timeout ответа icmp от хоста (по умаолчанию - 1 сек)
 
+    Сами icmp запросы отправляет ICMPEngine, общий для всех проверок.
+
     При создании класса, конструктор сразу создаёт ассинхронную задачу,
     пинг всех хостов в цикле
     """
@@ -23,10 +859,25 @@ class Pinger:
     def __init__(self):
 
         self.parent_server = None
+        self.hosts = None  # HostTable сервера
+        self.probe_stats = None  # ProbeStats сервера
+        self.history = None  # HistoryStore сервера
+        self.alerts = None  # AlertDispatcher сервера
         self.loop = asyncio.get_event_loop()
+        self.engine = ICMPEngine()
+        self.sweeps = SweepCoordinator(self)
+        self.scheduler = ProbeScheduler()
+        self.confirmations = ConfirmationQueue()
+        self._ADAPTIVE = True
+        self._in_flight = {}  # ip проверяемого хоста -> future с результатом (создаётся, если кто-то ждёт)
+        self._coalesced = 0  # ручных запросов, присоединённых к уже идущей проверке
     
     def set_parent_server(self, parent):
         self.parent_server = parent
+        self.hosts = parent.hosts
+        self.probe_stats = parent.probe_stats
+        self.history = parent.history
+        self.alerts = parent.alerts
     
     def set_icmp_params(self, auto_ping, icmp_with_host, icmp_interval, ping_hosts_per_sec, icmp_timeout):
         self._AUTO_PING_INTERVAL = auto_ping
@@ -34,114 +885,274 @@ class Pinger:
         self._ICMP_INTERVAL = icmp_interval
         self._ICMP_PER_SECOND = ping_hosts_per_sec
         self._ICMP_TIMEOUT = icmp_timeout
+        self.engine.set_rate(ping_hosts_per_sec)
+        self.scheduler.set_intervals(auto_ping, self.scheduler.ceiling)
+
+    def set_workers(self, workers):
+        """
+        workers > 0 - icmp отправляют отдельные процессы (ShardedEngine),
+        0 - всё в текущем цикле событий (ICMPEngine)
+        """
+        if workers > 0:
+            self.engine = ShardedEngine(workers, rate=self._ICMP_PER_SECOND)
+
+    def set_schedule_params(self, adaptive, max_probe_interval):
+        """
+        adaptive - проверять хосты по индивидуальному расписанию (ProbeScheduler),
+        иначе - полными проверками всех хостов раз в auto_ping сек.
+        max_probe_interval - максимальный интервал проверки стабильного хоста
+        """
+        self._ADAPTIVE = adaptive
+        self.scheduler.set_intervals(self.scheduler.base, max_probe_interval)
 
     def run_ping_loop(self) -> None:
         self.loop.create_task(self._run_auto_ping())
+        self.loop.create_task(self._run_confirmations())
 
-    async def _icmp_ping_host(self, ip):
-        try:
-            hst = db.one_info(ip)  # вся инфа о хосте
-            if hst[3] == 'offline':
-                db.change_state(ip, 'clock.offline')
-            elif hst[3] == 'online':
-                db.change_state(ip, 'clock.online')
-
-            host = await async_ping(ip,
-                                    count=self._ICMP_COUNT,
-                                    interval=self._ICMP_INTERVAL,
-                                    timeout=self._ICMP_TIMEOUT)
+    def _mark_checking(self, hst):
+        # перед отправкой icmp хост помечается как проверяемый
+        if hst[3] == 'offline':
+            self.hosts.set_state(hst[0], 'clock.offline')
+        elif hst[3] == 'online':
+            self.hosts.set_state(hst[0], 'clock.online')
 
+    def _process_reply(self, hst, host):
+        """обработка результата пинга хоста: смена состояния, логи, sms"""
+        try:
+            ip = hst[0]
+            current = self.hosts.get(ip)
+            if current is None or current[3] == 'pause':
+                # хост удалён или поставлен на паузу, пока шла проверка - результат не нужен
+                return
             current_time = int(time.time())
+            if host.is_alive:
+                changed = hst[3] == 'offline' or hst[3] == 'clock.offline'
+            else:
+                changed = hst[3] == 'online' or hst[3] == 'clock.online'
+            if self._ADAPTIVE:
+                # без расписания heap никто не разбирает - записи копились бы с каждой проверкой
+                self.scheduler.update(ip, changed, self.loop.time())
+            self.probe_stats.add(ip, host)
+            self.history.add(ip, host)
 
             if host.is_alive:
                 # если хост ответил на icmp
+                self.confirmations.discard(ip)
                 self.parent_server.log.icmp_good(hst)  # ЛОГ
-                if hst[3] == 'offline' or hst[3] == 'clock.offline':
-                    db.change_time(ip, current_time)
+                if changed:
                     self.parent_server.log.change_state(f'Хост <{hst[0]}> {hst[1]}  [включился]')
                     if hst[6]:
                         try:
                             sms_data = json.loads(hst[6])
                             if sms_data['online']:
-                                self.loop.create_task(self.send_sms(sms_data['online_url']))
-                                self.parent_server.log.alarm(f'SMS оповещение о включении хоста <{ip}> отправлено')
+                                self.alerts.push(f'Хост <{ip}> {hst[1]} включился', sms_data.get('online_url'))
                         except (Exception,):
                             pass
-                db.change_state(ip, 'online')
+                self.hosts.set_state(ip, 'online', current_time if changed else None)
 
             else:
                 # если хост не ответил на icmp
                 self.parent_server.log.icmp_bad(hst)  # ЛОГ
-                if hst[3] == 'online' or hst[3] == 'clock.online':
-                    db.change_time(ip, current_time)
+                if changed:
                     self.parent_server.log.change_state(f'Хост <{hst[0]}> {hst[1]}  [отключился]')
                     if hst[6]:
                         try:
                             sms_data = json.loads(hst[6])
                             if sms_data['offline']:
+                                text = f'Хост <{ip}> {hst[1]} отключился'
                                 if sms_data['double_check']:
-                                    self.loop.create_task(self.check_host_sms(ip, sms_data['offline_url']))
+                                    self.confirmations.add(ip, sms_data.get('offline_url'), text, self.loop.time())
                                 else:
-                                    self.loop.create_task(self.send_sms(sms_data['offline_url']))
+                                    self.alerts.push(text, sms_data.get('offline_url'))
                         except (Exception,):
                             pass
-                db.change_state(ip, 'offline')
+                self.hosts.set_state(ip, 'offline', current_time if changed else None)
         except (Exception,):
             return
 
-    async def check_host_sms(self, ip, url):
-        """Дополнительная проверка хоста перед отправкой sms"""
-        await asyncio.sleep(30)
+    async def _ping_all(self):
+        # пинг всех хостов в БД, вернёт кол-во проверенных хостов
+        all_hosts = self.hosts.rows()
+        if not all_hosts:
+            return 0
+        hosts = [host for host in all_hosts if host[3] != 'pause']
+        await self._probe(hosts, len(hosts))
+        return len(hosts)
+
+    async def _run_auto_ping(self):
+        if self._ADAPTIVE:
+            await self._run_scheduled_ping()
+            return
+        # цикл автоматического пинга всех хостов, с определённым интервалом;
+        # следующая проверка не начнётся, пока не закончилась предыдущая
+        while True:
+            started = self.loop.time()
+            await self.sweeps.run(show_alarm=True)
+            await asyncio.sleep(max(self._AUTO_PING_INTERVAL - (self.loop.time() - started), 0))
+
+    async def _run_scheduled_ping(self):
+        # цикл проверки хостов по индивидуальному расписанию
+        next_sync = 0
+        while True:
+            now = self.loop.time()
+            if now >= next_sync:
+                try:
+                    self.scheduler.sync(self.hosts.rows(), now)
+                except (Exception,):
+                    pass
+                next_sync = now + self._AUTO_PING_INTERVAL
+            due = self.scheduler.pop_due(now)
+            if due:
+                self.loop.create_task(self._ping_hosts(due))
+            next_due = self.scheduler.next_due()
+            wait = 1 if next_due is None else min(max(next_due - now, 0.05), 1)
+            await asyncio.sleep(wait)
+
+    async def _run_confirmations(self):
+        # дополнительная проверка отключившихся хостов перед оповещением, пачками
+        while True:
+            next_due = self.confirmations.next_due()
+            now = self.loop.time()
+            await asyncio.sleep(1 if next_due is None else min(max(next_due - now, 0.05), 1))
+            due = self.confirmations.pop_due(self.loop.time())
+            if due:
+                self.loop.create_task(self._confirm(due))
+
+    async def _confirm(self, due):
+        # перепроверка пачки хостов; не ответившие получают оповещение
+        alive = set()
         try:
-            host = await async_ping(ip, count=5, interval=1, timeout=1)
-            if host.is_alive:
-                return
-            else:
-                await self.send_sms(url)
-                self.parent_server.log.alarm(f'SMS оповещение об отключении хоста <{ip}> отправлено')
-                return
+            await self.engine.ping_many(iter(due), lambda ip, host: host.is_alive and alive.add(ip),
+                                        count=await self.alerts.icmp_count(), interval=1, timeout=1,
+                                        total=len(due))
         except (Exception,):
-            await self.send_sms(url)
-            self.parent_server.log.alarm(f'SMS оповещение об отключении хоста <{ip}> отправлено')
+            pass
+        confirmed = []
+        for ip, (url, text, offline_time) in due.items():
+            current = self.hosts.get(ip)
+            if ip in alive or current is None or current[3] == 'pause':
+                continue
+            self.alerts.push(text, url)
+            confirmed.append(offline_time)
+        self.confirmations.finished(confirmed, len(due) - len(confirmed), self.loop.time())
+        if confirmed:
+            self.parent_server.log.alarm(f'Отключение подтверждено повторной проверкой, хостов: {len(confirmed)}')
 
-    @staticmethod
-    async def send_sms(url):
-        """Отправка sms"""
-        pass
+    async def _ping_hosts(self, ips):
+        # пинг хостов, которым подошло время по расписанию
+        def hosts():
+            for ip in ips:
+                hst = self.hosts.get(ip)
+                if hst is None or hst[3] == 'pause':
+                    self.scheduler.discard(ip)
+                    continue
+                yield hst
 
-    async def _ping_all(self, show_alarm=True):
-        # пинг всех хостов в БД
-        all_hosts = db.all_info()
-        if show_alarm:
-            self.parent_server.log.alarm('Через 10 секунд начнётся плановая проверка всех хостов')
-            await asyncio.sleep(10)
-        if all_hosts:
-            for c, host in enumerate(all_hosts):
-                if host[3] != 'pause':
-                    self.loop.create_task(self._icmp_ping_host(host[0]))
-                    await asyncio.sleep(1 / self._ICMP_PER_SECOND)
-
-    async def _ping_one(self, ip):
-        # поиск хоста по IP в БД, если найден, тогда отправить пинг
-        self.loop.create_task(self._icmp_ping_host(ip))
+        await self._probe(hosts(), len(ips))
 
-    async def _run_auto_ping(self):
-        # цикл автоматического пинга всех хостов, с определённым интервалом
-        while True:
-            self.loop.create_task(self._ping_all())
-            await asyncio.sleep(self._AUTO_PING_INTERVAL)  # интервал итараций цикла
+    async def _probe(self, hosts, total, claimed=False):
+        """
+        пинг хостов (строки HostTable) одним вызовом движка.
+        Хосты, которые уже проверяются, пропускаются - их результат придёт из идущей проверки.
+        claimed - хосты уже зарегистрированы в _in_flight вызывающим (ручная проверка)
+        """
+        rows = {hst[0]: hst for hst in hosts} if claimed else {}
+
+        def addresses():
+            if claimed:
+                for hst in rows.values():
+                    self._mark_checking(hst)
+                    yield hst[0]
+                return
+            # хосты регистрируются по мере отправки, а не все сразу в начале проверки
+            for hst in hosts:
+                ip = hst[0]
+                if ip in self._in_flight:
+                    continue
+                self._in_flight[ip] = None
+                rows[ip] = hst
+                self._mark_checking(hst)
+                yield ip
+
+        def on_result(ip, host):
+            self._process_reply(rows.pop(ip), host)
+            self._release(ip, host)
+
+        try:
+            await self.engine.ping_many(addresses(), on_result,
+                                        count=self._ICMP_COUNT,
+                                        interval=self._ICMP_INTERVAL,
+                                        timeout=self._ICMP_TIMEOUT,
+                                        total=total)
+        finally:
+            # хосты, по которым движок не вернул результат (например, упал процесс-обработчик):
+            # состояние до проверки возвращается, и хост снова ставится в расписание
+            now = self.loop.time()
+            for ip, hst in rows.items():
+                current = self.hosts.get(ip)
+                if current is not None and current[3] != hst[3] and current[3].startswith('clock.'):
+                    self.hosts.set_state(ip, hst[3])
+                if self._ADAPTIVE:
+                    self.scheduler.update(ip, True, now)
+                self._release(ip)
+
+    def _release(self, ip, host=None):
+        # проверка хоста закончена, ожидающие получают результат (None - без результата)
+        waiter = self._in_flight.pop(ip, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(host)
+
+    def request_probe(self, ips):
+        """
+        ручная проверка хостов. Хосты, которые уже проверяются (любой проверкой),
+        повторно не пингуются - запрос присоединяется к идущей проверке.
+        Вернёт {ip: future}, результат future - icmplib.Host или None
+        """
+        waiters = {}
+        rows = []
+        for ip in ips:
+            if ip in waiters:
+                continue
+            if ip in self._in_flight:
+                self._coalesced += 1
+            else:
+                hst = self.hosts.get(ip)
+                if hst is None or hst[3] == 'pause':
+                    continue
+                self._in_flight[ip] = None
+                rows.append(hst)
+            waiter = self._in_flight[ip]
+            if waiter is None:
+                waiter = self._in_flight[ip] = self.loop.create_future()
+            waiters[ip] = waiter
+        if rows:
+            self.loop.create_task(self._probe(rows, len(rows), claimed=True))
+        return waiters
 
     def start_ping_all(self):
-        self.loop.create_task(self._ping_all(show_alarm=False))
+        """ручной запуск проверки всех хостов, вернёт 'started', 'merged' или 'queued'"""
+        return self.sweeps.request(manual=True)
 
     def start_ping_one(self, ip):
-        self.loop.create_task(self._ping_one(ip))
+        """
+        ручная проверка хоста, вернёт 'started', 'merged' (хост уже проверяется),
+        'not found' (хоста нет) или 'paused' (хост на паузе не проверяется)
+        """
+        hst = self.hosts.get(ip)
+        if hst is None:
+            return 'not found'
+        if hst[3] == 'pause':
+            return 'paused'
+        merged = ip in self._in_flight
+        self.request_probe((ip,))
+        return 'merged' if merged else 'started'
 
     def start_ping_dead(self):
-        hosts = db.all_info()
-        for host in hosts:
-            if host[3] == 'offline' or host[3] == 'clock.offline':
-                self.start_ping_one(host[0])
+        """ручная проверка недоступных хостов, вернёт кол-во хостов: {'started': .., 'merged': ..}"""
+        dead = [host[0] for host in self.hosts.rows() if host[3] == 'offline' or host[3] == 'clock.offline']
+        merged = sum(1 for ip in dead if ip in self._in_flight)
+        self.request_probe(dead)
+        return {'started': len(dead) - merged, 'merged': merged}
 
     def set_icmp_interval(self, seconds):
         self._ICMP_INTERVAL = seconds
@@ -151,9 +1162,21 @@ class Pinger:
 
     def set_auto_ping_interval(self, seconds):
         self._AUTO_PING_INTERVAL = seconds
+        self.scheduler.set_intervals(seconds, self.scheduler.ceiling)
 
     def set_icmp_count(self, count):
         self._ICMP_COUNT = count
 
     def set_icmp_per_second(self, count):
-        self._ICMP_PER_SECOND = count
\ No newline at end of file
+        self._ICMP_PER_SECOND = count
+        self.engine.set_rate(count)
+
+    def stats(self):
+        """текущая статистика пингера"""
+        stats = self.engine.stats()
+        stats['sweep'] = self.sweeps.stats()
+        stats['schedule'] = self.scheduler.stats() if self._ADAPTIVE else None
+        stats['probes'] = {'checking': len(self._in_flight), 'coalesced': self._coalesced}
+        stats['alerts'] = self.alerts.stats()
+        stats['confirm'] = self.confirmations.stats()
+        return stats
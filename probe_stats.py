@@ -0,0 +1,95 @@
+import array
+import math
+
+
+class ProbeStats:
+    """
+    Кольцевые буферы последних результатов проверки каждого хоста.
+
+    Все буферы лежат в нескольких общих array.array: хосту выделяется слот
+    из window записей (средний RTT, jitter, потери), поэтому на одно измерение
+    не создаётся ни одного python-объекта, а память ограничена
+    кол-во хостов * window * 9 байт (100 тыс. хостов при window=32 - около 29 МБ).
+    """
+
+    PERCENTILES = (50, 90, 95, 99)
+
+    def __init__(self, window=32):
+        self.window = window
+        self._slots = {}  # ip -> номер слота
+        self._free = []  # освободившиеся слоты удалённых хостов
+        self._rtt = array.array('f')  # средний RTT проверки, мс (NaN - хост не ответил)
+        self._jitter = array.array('f')  # мс
+        self._loss = array.array('B')  # потери, %
+        self._pos = array.array('I')  # позиция следующей записи в слоте
+        self._count = array.array('I')  # кол-во записей в слоте (не больше window)
+        self._empty_f = array.array('f', [0.0]) * window
+        self._empty_b = array.array('B', [0]) * window
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _slot(self, ip):
+        slot = self._slots.get(ip)
+        if slot is not None:
+            return slot
+        if self._free:
+            slot = self._free.pop()
+            self._pos[slot] = 0
+            self._count[slot] = 0
+        else:
+            slot = len(self._pos)
+            self._rtt.extend(self._empty_f)
+            self._jitter.extend(self._empty_f)
+            self._loss.extend(self._empty_b)
+            self._pos.append(0)
+            self._count.append(0)
+        self._slots[ip] = slot
+        return slot
+
+    def add(self, ip, host):
+        """записать результат проверки (icmplib.Host)"""
+        slot = self._slot(ip)
+        pos = self._pos[slot]
+        i = slot * self.window + pos
+        self._rtt[i] = host.avg_rtt if host.is_alive else math.nan
+        self._jitter[i] = host.jitter
+        self._loss[i] = int(round(host.packet_loss * 100))
+        self._pos[slot] = (pos + 1) % self.window
+        if self._count[slot] < self.window:
+            self._count[slot] += 1
+
+    def remove(self, ip):
+        slot = self._slots.pop(ip, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def rename(self, ip, new_ip):
+        slot = self._slots.pop(ip, None)
+        if slot is not None:
+            self._slots[new_ip] = slot
+
+    def summary(self, ip):
+        """перцентили RTT, jitter и потери за окно буфера, или None если измерений нет"""
+        slot = self._slots.get(ip)
+        if slot is None or not self._count[slot]:
+            return
+        start = slot * self.window
+        count = self._count[slot]
+        rtts = sorted(rtt for rtt in self._rtt[start:start + count] if not math.isnan(rtt))
+        jitters = [self._jitter[start + i] for i in range(count) if not math.isnan(self._rtt[start + i])]
+        loss = sum(self._loss[start:start + count]) / count
+
+        result = {
+            'samples': count,
+            'replied': len(rtts),
+            'loss': round(loss, 2),
+            'rtt_min': round(rtts[0], 3) if rtts else None,
+            'rtt_max': round(rtts[-1], 3) if rtts else None,
+            'rtt_avg': round(sum(rtts) / len(rtts), 3) if rtts else None,
+            'jitter_avg': round(sum(jitters) / len(jitters), 3) if jitters else None,
+        }
+        for p in self.PERCENTILES:
+            # nearest-rank перцентиль
+            result[f'rtt_p{p}'] = round(rtts[max(math.ceil(p / 100 * len(rtts)) - 1, 0)], 3) if rtts else None
+        return result
@@ -1,6 +1,7 @@
 import asyncio
 import sys
 
+import db
 from simple_logger import Logger
 from stream_server import Server
 from pinger import Pinger
@@ -23,6 +24,12 @@ def main():
         event_loop.run_forever()
     except KeyboardInterrupt:
         sys.exit(0)
+    finally:
+        server.db.close()  # дождаться записи очереди потока записи
+        server.hosts.flush()  # записать в БД состояния хостов, которые ещё не записаны
+        server.history.flush()
+        db.close()
+        logger.close()  # дописать очередь лога в файл
 
 
 if __name__ == '__main__':
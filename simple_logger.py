@@ -1,17 +1,69 @@
 import json
 import datetime
+import glob
+import gzip
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import db
 
 
 class Logger:
     """
     Простой логер событий.
+
+    Запись в файл не выполняется в цикле событий: строки ставятся в очередь,
+    фоновый поток дописывает их в файл пачками - как только накопилось _FLUSH_SIZE байт
+    или прошло _FLUSH_INTERVAL сек. с первой строки пачки.
+    Файл ротируется при смене суток и при превышении max_bytes: текущий файл
+    сжимается в <file_path>.<дата-время>.gz, хранятся последние backups сжатых файлов.
+
+    Те же события той же пачкой записываются в таблицу events (db.insert_events)
+    с типом ('alarm', 'user', 'state'), логином и адресом хоста из текста события,
+    для выборок по периоду и фильтрам (db.query_events); события старше events_days удаляются.
+    Запись в БД идёт через поток записи AsyncDB (set_database), единственный писатель БД;
+    пока его нет (запуск и остановка сервера) - напрямую. Неудачная запись повторяется
+    _DB_RETRIES раз, затем пачка событий считается потерянной и это отмечается в файле лога.
     """
-    def __init__(self, file_path: str):
+
+    _FLUSH_INTERVAL = 1  # сек.
+    _FLUSH_SIZE = 64 * 1024  # байт
+    _PURGE_INTERVAL = 3600  # сек.
+    _DB_RETRIES = 3
+    _DB_RETRY_DELAY = 1  # сек., удваивается с каждой попыткой
+    _HOST = re.compile(r'[Хх]ост\w* <([^<>]+)>')  # адрес хоста в тексте события
+
+    def __init__(self, file_path: str, max_bytes=10 * 1024 * 1024, backups=10, events_days=90):
         self._file_path = file_path
-    
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._events_days = events_days
+        self._icmp_callback = None
+        self._database = None  # AsyncDB
+        self._records = queue.SimpleQueue()  # (время, текст, тип, логин), None - остановка
+        self._writer = threading.Thread(target=self._write_loop, name='log-write', daemon=True)
+        self._writer.start()
+
+    def set_rotation(self, max_bytes, backups, events_days=90):
+        """размер файла для ротации (байт), кол-во хранимых сжатых файлов и сколько суток хранить события в БД"""
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._events_days = events_days
+
+    def set_database(self, database):
+        """записывать события в БД через поток записи AsyncDB"""
+        self._database = database
+
     def set_callback_broadcast(self, func: callable):
         self._broadcast_callback = func
 
+    def set_callback_icmp(self, func: callable):
+        """рассылка icmp событий отдельной функцией (принимает событие dict), например пачками"""
+        self._icmp_callback = func
+
     def alarm(self, msg):
         """предупреждения, ошибки, флуды"""
         evnt = {
@@ -19,7 +71,7 @@ class Logger:
             'message': msg
         }
         self._send(evnt)
-        self._write_logfile(msg)
+        self._write_logfile(msg, 'alarm')
 
     def icmp_bad(self, host):
         """хост не доступен"""
@@ -29,7 +81,7 @@ class Logger:
             'name': host[1],
             'state': False
         }
-        self._send(evnt)
+        self._send_icmp(evnt)
 
     def icmp_good(self, host):
         """пинг пройден успешно"""
@@ -39,7 +91,7 @@ class Logger:
             'name': host[1],
             'state': True
         }
-        self._send(evnt)
+        self._send_icmp(evnt)
 
     def user_event(self, login, access, ip, msg):
         """отображение действий пользователей"""
@@ -51,10 +103,10 @@ class Logger:
             'access': access
         }
         self._send(evnt)
-        self._write_logfile(f'{login}: {msg}')
+        self._write_logfile(msg, 'user', login)
 
     def change_state(self, msg):
-        self._write_logfile(msg)
+        self._write_logfile(msg, 'state')
 
     def _send(self, obj):
         """разослать лог"""
@@ -62,7 +114,138 @@ class Logger:
             {'response': 33, 'data': obj})
         self._broadcast_callback(msg)
 
-    def _write_logfile(self, msg):
-        with open(file=self._file_path, mode='a', encoding='utf-8') as file:
-            time_log = datetime.datetime.now().strftime('%Y/%m/%d  %H:%M:%S')
-            file.write(f'[{time_log}]  {msg}\n')
\ No newline at end of file
+    def _send_icmp(self, obj):
+        if self._icmp_callback is not None:
+            self._icmp_callback(obj)
+        else:
+            self._send(obj)
+
+    def _write_logfile(self, msg, kind, login=None):
+        self._records.put((datetime.datetime.now(), msg, kind, login))
+
+    def close(self):
+        """дописать очередь в файл и остановить поток записи"""
+        self._records.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        db.init_events()
+        last_purge = 0
+        stop = False
+        while not stop:
+            record = self._records.get()
+            if record is None:
+                break
+            batch = [record]
+            size = len(record[1])
+            deadline = time.monotonic() + self._FLUSH_INTERVAL
+            while size < self._FLUSH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self._records.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+                size += len(record[1])
+            try:
+                self._write(batch)
+            except (Exception,):
+                pass
+            rows = [(moment.timestamp(), kind, login, self._host(msg), msg) for moment, msg, kind, login in batch]
+            if self._db_write(db.insert_events, rows) != 'success':
+                self._report(f'Не удалось записать в БД событий лога: {len(rows)}')
+            if time.time() - last_purge >= self._PURGE_INTERVAL:
+                last_purge = time.time()
+                if self._db_write(db.delete_events, last_purge - self._events_days * 86400) != 'success':
+                    self._report('Не удалось удалить из БД устаревшие события лога')
+        db.close()
+
+    def _db_write(self, func, *args):
+        # выполнить функцию записи db.py через AsyncDB (или напрямую, если его нет) с повторами
+        delay = self._DB_RETRY_DELAY
+        result = 'unknown error'
+        for attempt in range(self._DB_RETRIES + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            future = self._database.write_threadsafe(func, *args) if self._database is not None else None
+            try:
+                result = future.result() if future is not None else func(*args)
+            except (Exception,):
+                result = 'unknown error'
+            if result == 'success':
+                break
+        return result
+
+    def _report(self, msg):
+        # ошибка самого логера: в файл лога и в консоль, без записи в БД
+        time_log = datetime.datetime.now().strftime('%Y/%m/%d  %H:%M:%S')
+        print(msg)
+        try:
+            self._append([f'[{time_log}]  {msg}\n'])
+        except (Exception,):
+            pass
+
+    def _host(self, msg):
+        # адрес хоста, о котором событие, или None
+        match = self._HOST.search(msg)
+        return match.group(1) if match else None
+
+    def _write(self, batch):
+        # дописать пачку строк, ротируя файл при смене суток и превышении размера
+        lines = []
+        size = self._file_size()
+        day = self._file_day()
+        for moment, msg, kind, login in batch:
+            time_log = moment.strftime('%Y/%m/%d  %H:%M:%S')
+            line = f'[{time_log}]  {login}: {msg}\n' if kind == 'user' else f'[{time_log}]  {msg}\n'
+            length = len(line.encode('utf-8'))
+            if day is not None and (moment.date() != day or size + length > self._max_bytes):
+                self._append(lines)
+                self._rotate()
+                lines, size = [], 0
+            lines.append(line)
+            size += length
+            day = moment.date()
+        self._append(lines)
+
+    def _append(self, lines):
+        if lines:
+            with open(file=self._file_path, mode='a', encoding='utf-8') as file:
+                file.write(''.join(lines))
+
+    def _file_size(self):
+        try:
+            return os.path.getsize(self._file_path)
+        except OSError:
+            return 0
+
+    def _file_day(self):
+        # дата последней записи в файл, None - файла нет или он пуст
+        try:
+            if os.path.getsize(self._file_path):
+                return datetime.date.fromtimestamp(os.path.getmtime(self._file_path))
+        except OSError:
+            pass
+
+    def _rotate(self):
+        # сжать текущий файл и удалить самые старые сжатые файлы
+        if not self._file_size():
+            return
+        stamp = datetime.datetime.fromtimestamp(os.path.getmtime(self._file_path)).strftime('%Y%m%d-%H%M%S')
+        rotated = f'{self._file_path}.{stamp}.gz'
+        number = 0
+        while os.path.exists(rotated):
+            number += 1
+            rotated = f'{self._file_path}.{stamp}-{number}.gz'
+        with open(self._file_path, 'rb') as source, gzip.open(rotated, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.remove(self._file_path)
+        rotated_files = sorted(glob.glob(f'{glob.escape(self._file_path)}.*.gz'), key=os.path.getmtime)
+        for old in rotated_files[:max(len(rotated_files) - self._backups, 0)]:
+            os.remove(old)
\ No newline at end of file
@@ -4,6 +4,15 @@ import asyncio
 import json
 import datetime
 import db
+from host_table import HostTable
+from host_snapshot import HostSnapshot
+from probe_stats import ProbeStats
+from history_store import HistoryStore
+from alerts import AlertDispatcher
+from async_db import AsyncDB
+from credentials import Credentials
+from event_batcher import EventBatcher
+from stream_server_proto.client_sender import ClientSender
 
 
 class Server(socket.socket):
@@ -14,6 +23,26 @@ class Server(socket.socket):
 
     clients = {} 
 
+    # необязательные параметры конфигурационного файла и их значения по умолчанию
+    _OPTIONAL_PROPERTIES = {
+        'AdaptivePing': '1',  # 1 - проверка хостов по индивидуальному расписанию, 0 - полными проверками
+        'MaxProbeInterval': '600',  # максимальный интервал проверки стабильного хоста, сек.
+        'StateFlushInterval': '2',  # интервал записи состояний хостов в БД, сек.
+        'StatsWindow': '32',  # кол-во последних проверок хоста для статистики RTT/потерь
+        'HistoryDir': 'history',  # папка истории проверок
+        'HistoryRawDays': '2',  # сколько суток хранить сырые результаты проверок
+        'PingerWorkers': '0',  # кол-во процессов для отправки icmp (0 - в основном процессе)
+        'LogMaxSize': '10',  # размер файла лога для ротации, МБ
+        'LogBackups': '10',  # сколько хранить сжатых файлов лога
+        'LogEventsDays': '90',  # сколько суток хранить события лога в БД для выборок
+        'MaxFrameSize': '16',  # максимальный размер пакета от клиента, МБ
+        'EventBatchWindow': '0.2',  # сек. накопления icmp событий для клиентов с пакетным форматом
+        'EventBatchSize': '500',  # максимум icmp событий в одной пачке
+        'SendQueueSize': '1000',  # максимум пакетов в очереди отправки клиента до применения SendQueuePolicy
+        'SendQueuePolicy': 'coalesce',  # при переполнении очереди: drop, coalesce или disconnect
+        'JournalSize': '100000',  # кол-во хостов в журнале изменений для GET HOST {'since': ревизия}
+    }
+
     def __init__(self, logger, proto, handler, pinger):
         """
         Инициализация сокета сервера,
@@ -24,14 +53,40 @@ class Server(socket.socket):
         """
         self.log = logger
         self.log.set_callback_broadcast(self.broadcast_send)
+        self.log.set_callback_icmp(self.icmp_broadcast)
         self.protocol = proto  # поверх TCP
         self.request_handler = handler  # обработчик
         self.request_handler.set_parent_server(self) # передача сервера в обработчик
+        self.properties = self.load_properties()  # загрузка параметров из конфигурационного файла
+        self.batched_clients = set()  # сокеты клиентов, получающих icmp события пачками
+        self.senders = {}  # сокет клиента -> ClientSender, очередь отправки
+        self.icmp_batcher = EventBatcher(lambda msg: self.broadcast_send(msg, self.batched_clients, icmp=True),
+                                         window=float(self.properties['EventBatchWindow']),
+                                         max_events=int(self.properties['EventBatchSize']))
+        self.protocol.set_max_frame_size(int(float(self.properties['MaxFrameSize']) * 1024 * 1024))
+        self.log.set_rotation(max_bytes=int(float(self.properties['LogMaxSize']) * 1024 * 1024),
+                              backups=int(self.properties['LogBackups']),
+                              events_days=float(self.properties['LogEventsDays']))
+        self.db = AsyncDB()  # запросы к БД вне цикла событий
+        self.log.set_database(self.db)  # события лога - через тот же поток записи
+        self.users = Credentials(self.db)  # учётные записи для авторизации
+        self.hosts = HostTable(flush_interval=float(self.properties['StateFlushInterval']),
+                               database=self.db,
+                               journal_size=int(self.properties['JournalSize']))  # хосты в памяти
+        self.hosts.load()
+        self.snapshot = HostSnapshot(self.hosts, self.protocol,
+                                     max_age=float(self.properties['StateFlushInterval']))  # готовые списки хостов
+        self.probe_stats = ProbeStats(window=int(self.properties['StatsWindow']))  # последние RTT/потери хостов
+        self.history = HistoryStore(path=self.properties['HistoryDir'],
+                                    raw_days=int(self.properties['HistoryRawDays']))  # история проверок
+        self.alerts = AlertDispatcher(logger=self.log, database=self.db)  # отправка SMS оповещений
         self.pinger = pinger  # pinger объект
         self.pinger.set_parent_server(self)
         self.pinger.set_icmp_params(*db.icmp_params())
+        self.pinger.set_workers(int(self.properties['PingerWorkers']))
+        self.pinger.set_schedule_params(adaptive=self.properties['AdaptivePing'] == '1',
+                                        max_probe_interval=int(self.properties['MaxProbeInterval']))
         self.pinger.run_ping_loop()
-        self.properties = self.load_properties()  # загрузка параметров из конфигурационного файла
 
         self._ADMIN_USER = {'login': self.properties['DefaultAdminLogin'], 'password': self.properties['DefaultAdminPassw']}
         self.PORT = int(self.properties['TcpPort'])
@@ -54,23 +109,19 @@ class Server(socket.socket):
         time_format = str(datetime.timedelta(seconds=int(n)))
         return time_format
 
-    @staticmethod
-    def load_properties():
+    @classmethod
+    def load_properties(cls):
         try:
-            def unpack(s, value):
-                if value in s:
-                    return s[len(value + ' = '):]
-
-            params = {}
+            params = dict(cls._OPTIONAL_PROPERTIES)
             with open(file='server.settings.ini', mode='r') as file:
-                data = file.read().split('\n')
+                for line in file.read().split('\n'):
+                    if '=' in line:
+                        param, value = line.split('=', 1)
+                        params[param.strip()] = value.strip()
                 for param in ('Ip', 'TcpPort', 'TimeoutConnection', 'DefaultAdminLogin', 'DefaultAdminPassw', 'HttpPort'):
-                    for line in data:
-                        if param in line:
-                            params[param] = unpack(line, param)
-                if len(params) == 6:
-                    return params
-                return
+                    if param not in params:
+                        return
+                return params
         except (Exception,):
             print('Ошибка инициализации сервера: проверьте конфигурационный файл сервера: server.settings.ini')
             return
@@ -78,6 +129,9 @@ class Server(socket.socket):
     def run(self):
         # запуск сервера через метод принятия соединений от клиентов
         self.loop.create_task(self._accept_client())
+        self.loop.create_task(self.hosts.run_flusher())
+        self.loop.create_task(self.history.run())
+        self.loop.create_task(self.alerts.run())
         self.loop.create_task(self.watch_temp_web())
 
     def disconnect_user(self, ip):
@@ -92,12 +146,16 @@ class Server(socket.socket):
         if sock in self.clients:
             sock_addr, access, login = self.clients[sock]
             del self.clients[sock]
+            self.batched_clients.discard(sock)
+            sender = self.senders.pop(sock, None)
+            if sender is not None:
+                sender.close()
             try:
                 sock.close()
             except (Exception,):
                 pass
             self.log.user_event(login, access, sock_addr, msg=f'отключился от сервера {sock_addr}')  # вывод лога
-            db.change_last_online(login)  # изменение даты последнего посещения сервера в БД
+            self.db.write(db.change_last_online, login)  # изменение даты последнего посещения сервера в БД
 
     async def _accept_client(self):
         while True:
@@ -114,16 +172,16 @@ class Server(socket.socket):
         auth_ = await self.auth_client(client_sock)
         if auth_[0] == 'guest':
             # если зашёл обычный пользователь
+            self._add_sender(client_sock)  # ответ об авторизации - первым в очереди, до рассылок
             self.clients[client_sock] = (client_addr, 'guest', auth_[1])
             self.loop.create_task(self.recv_client(client_sock, client_addr, login=auth_[1]))  # запуск приёма байт от клиента
             self.log.user_event(auth_[1], 'guest', client_addr, f'подключился к серверу {client_addr}')  # вывод лога
-            await self.protocol.send_all(client_sock, self.request_handler.auth_success_response())
         elif auth_[0] == 'admin':
             # если зашел админ
+            self._add_sender(client_sock)
             self.clients[client_sock] = (client_addr, 'admin', auth_[1])
             self.loop.create_task(self.recv_client(client_sock, client_addr, auth_[1], 'admin'))
             self.log.user_event(auth_[1], 'admin', client_addr, f'подключился к серверу {client_addr}')  # вывод лога
-            await self.protocol.send_all(client_sock, self.request_handler.auth_success_response())
         else:
             # если неверный логин и пароль или сам запрос
             if auth_[0] == 'timeout':
@@ -143,20 +201,20 @@ class Server(socket.socket):
         try:
             auth = await asyncio.wait_for(self.protocol.recv(sock), timeout=15)
             data = json.loads(auth)  # декодирование json строки в объект python
-            for user in db.registered_users():
-                if data == {'login': user[0], 'password': user[1]}:
-                    if user[2] == 'guest' or user[2] == 'admin':
-                        # self._alias_connected_login(user[0])
-                        return user[2], user[0]
-                    else:
-                        return None, None
-                elif data == self._ADMIN_USER:
-                    # self._alias_connected_login(self._ADMIN_USER['login'])
-                    return 'admin', self._ADMIN_USER['login']
-                elif data['login'] == user[0]:
-                    return 'login/passw', user[0]
-                elif data['login'] == self._ADMIN_USER['login']:
-                    return 'login/passw', self._ADMIN_USER['login']
+            user = await self.users.get(data['login'])
+            if user is not None and data == {'login': user[0], 'password': user[1]}:
+                if user[2] == 'guest' or user[2] == 'admin':
+                    # self._alias_connected_login(user[0])
+                    return user[2], user[0]
+                else:
+                    return None, None
+            elif data == self._ADMIN_USER:
+                # self._alias_connected_login(self._ADMIN_USER['login'])
+                return 'admin', self._ADMIN_USER['login']
+            elif user is not None:
+                return 'login/passw', user[0]
+            elif data['login'] == self._ADMIN_USER['login']:
+                return 'login/passw', self._ADMIN_USER['login']
             return None, None
         except asyncio.exceptions.TimeoutError:
             return 'timeout', None
@@ -182,13 +240,68 @@ class Server(socket.socket):
             if not data:
                 self.close_socket(client_sock, client_addr)
                 break
-            response = self.request_handler.handler(data.decode('utf-8'), login, access)
-            await self.protocol.send_all(client_sock, response)
+            response = await self.request_handler.handler(data.decode('utf-8'), login, access, client_sock)
+            sender = self.senders.get(client_sock)
+            if sender is None:
+                break
+            await sender.send(response)  # следующий запрос - после отправки ответа
 
-    def broadcast_send(self, msg):
-        """Отправка сообщения всем подключенным клиентам"""
-        for sock in self.clients:
-            self.loop.create_task(self.protocol.send_all(sock, msg))
+    def _add_sender(self, sock):
+        """очередь отправки клиента, первым в неё ставится ответ об успешной авторизации"""
+        sender = self.senders[sock] = ClientSender(sock, self.protocol,
+                                                   limit=int(self.properties['SendQueueSize']),
+                                                   policy=self.properties['SendQueuePolicy'],
+                                                   on_overflow=self._send_queue_overflow)
+        sender.put(self.request_handler.auth_success_response())
+
+    def _send_queue_overflow(self, sock):
+        """клиент не успевает принимать данные - отключение"""
+        if sock in self.clients:
+            sock_addr, _, login = self.clients[sock]
+            self.log.alarm(f'Клиент [{login}] {sock_addr} отключен: переполнена очередь отправки')
+        self.close_socket(sock)
+
+    def broadcast_send(self, msg, socks=None, icmp=False, key=None):
+        """Отправка сообщения всем подключенным клиентам (или клиентам socks) через их очереди отправки"""
+        socks = self.clients if socks is None else socks
+        if not socks:
+            return
+        packet = self.protocol.pack(msg)  # сжатие один раз, всем клиентам - один и тот же пакет
+        for sock in list(socks):
+            sender = self.senders.get(sock)
+            if sender is not None:
+                sender.put(packet, icmp, key)
+
+    def icmp_broadcast(self, event):
+        """рассылка icmp события: пачкой клиентам с пакетным форматом, по одному - остальным"""
+        if self.batched_clients:
+            self.icmp_batcher.add(event)
+        if len(self.batched_clients) < len(self.clients):
+            self.broadcast_send(json.dumps({'response': 33, 'data': event}),
+                                [sock for sock in self.clients if sock not in self.batched_clients],
+                                icmp=True, key=event.get('ip'))
+
+    def set_batched_events(self, sock, enabled):
+        """включить/выключить для клиента получение icmp событий пачками"""
+        if enabled:
+            if sock in self.clients:
+                self.batched_clients.add(sock)
+        elif sock in self.batched_clients:
+            self.icmp_batcher.flush()  # уже накопленные события - ещё пачкой
+            self.batched_clients.discard(sock)
+
+    def host_changes(self, since):
+        """
+        изменения хостов после ревизии since для синхронизации клиента:
+        {'revision', 'full', 'updated', 'deleted'}; если журнал уже не содержит since
+        (или since=0) - full=True и в updated все хосты.
+        Состояния clock.online/clock.offline (хост проверяется) отдаются как online/offline
+        """
+        changes = self.hosts.changes(since)
+        if changes is None:
+            return {'revision': self.hosts.revision, 'full': True, 'updated': self.hosts.sync_rows(), 'deleted': []}
+        revision, updated, deleted = changes
+        return {'revision': revision, 'full': False, 'updated': updated, 'deleted': deleted}
 
     def current_event_loop(self):
         return self.loop
@@ -0,0 +1,112 @@
+import asyncio
+import collections
+
+
+class ClientSender:
+    """
+    Очередь отправки одного клиента.
+
+    Все пакеты клиенту (ответы на запросы и рассылки) ставятся в очередь и отправляются
+    одной задачей по порядку. Если клиент не успевает читать, очередь не растёт
+    бесконечно: при limit пакетов в очереди icmp события обрабатываются по политике policy:
+    - 'drop' - новые icmp события клиенту не отправляются;
+    - 'coalesce' - новое событие хоста заменяет его ещё не отправленное событие в очереди,
+      клиент получит актуальное состояние; событие хоста, которого в очереди нет, пропускается;
+    - 'disconnect' - клиент отключается.
+    Остальные пакеты (ответы, события пользователей) не отбрасываются,
+    но если их накопилось больше limit * _HARD_LIMIT, клиент отключается при любой политике.
+    """
+
+    POLICIES = ('drop', 'coalesce', 'disconnect')
+    _HARD_LIMIT = 4
+
+    def __init__(self, sock, protocol, limit=1000, policy='coalesce', on_overflow=None):
+        self.sock = sock
+        self.protocol = protocol
+        self.limit = limit
+        self.policy = policy if policy in self.POLICIES else 'coalesce'
+        self.on_overflow = on_overflow  # функция(sock) отключения клиента
+        self._queue = collections.deque()  # [пакет, ключ icmp события или None, future ответа или None]
+        self._latest = {}  # ключ icmp события (ip) -> запись в очереди, для политики coalesce
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, packet, icmp=False, key=None):
+        """поставить пакет в очередь; icmp - событие, к которому применяется политика переполнения"""
+        if self._closed:
+            return
+        if icmp and len(self._queue) >= self.limit:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return
+            if self.policy == 'disconnect':
+                self._overflow()
+                return
+            entry = self._latest.get(key) if key is not None else None
+            if entry is not None:
+                entry[0] = packet  # более новое состояние того же хоста
+                self.coalesced += 1
+            else:
+                self.dropped += 1  # события этого хоста (или пачки) в очереди нет - заменить нечего
+            return
+        elif len(self._queue) - len(self._latest) >= self.limit * self._HARD_LIMIT:
+            self._overflow()
+            return
+        entry = [packet, key if icmp else None, None]
+        if icmp and key is not None and self.policy == 'coalesce':
+            self._latest[key] = entry
+        self._queue.append(entry)
+        self._wakeup.set()
+
+    async def send(self, packet):
+        """поставить ответ в очередь и дождаться его отправки"""
+        if self._closed:
+            return
+        entry = [packet, None, asyncio.get_event_loop().create_future()]
+        self._queue.append(entry)
+        self._wakeup.set()
+        await entry[2]
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            entry = self._queue.popleft()
+            packet, key, future = entry
+            if key is not None and self._latest.get(key) is entry:
+                del self._latest[key]
+            try:
+                await self.protocol.send_all(self.sock, packet)
+                self.sent += 1
+            finally:
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+    def _overflow(self):
+        self.close()
+        if self.on_overflow is not None:
+            self.on_overflow(self.sock)
+
+    def close(self):
+        """остановить отправку, ожидающие ответы завершаются"""
+        if self._closed:
+            return
+        self._closed = True
+        self._task.cancel()
+        for _, _, future in self._queue:
+            if future is not None and not future.done():
+                future.set_result(None)
+        self._queue.clear()
+        self._latest.clear()
+
+    def stats(self):
+        return {'queue': len(self._queue), 'limit': self.limit, 'policy': self.policy,
+                'sent': self.sent, 'dropped': self.dropped, 'coalesced': self.coalesced}
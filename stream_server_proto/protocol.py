@@ -1,8 +1,88 @@
 import struct
+import weakref
 import zlib
 import asyncio
 
 
+class FrameReader:
+    """
+    Чтение пакетов протокола из одного сокета.
+
+    Байты читаются через sock_recv_into в буфер соединения (bytearray), который
+    переиспользуется между пакетами; пакет распаковывается прямо из буфера (memoryview),
+    без промежуточных копий. Если за одно чтение пришло несколько пакетов,
+    следующие разбираются из буфера без обращения к сокету.
+    Буфер растёт под пакет больше себя (не больше max_size) и возвращается
+    к исходному размеру, когда большой пакет прочитан.
+    """
+
+    _HEADER = struct.Struct('<I')
+    _BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, sock, loop, max_size):
+        self.sock = sock
+        self.loop = loop
+        self.max_size = max_size
+        self._buffer = bytearray(self._BUFFER_SIZE)
+        self._start = 0  # начало непрочитанных байт в буфере
+        self._end = 0  # конец непрочитанных байт
+
+    def _frame(self):
+        # разобрать пакет из буфера: (распакованные данные или None, сколько байт нужно для пакета)
+        available = self._end - self._start
+        if available < self._HEADER.size:
+            return None, self._HEADER.size
+        length = self._HEADER.unpack_from(self._buffer, self._start)[0]
+        if length > self.max_size:
+            raise ValueError(f'frame too large: {length}')
+        size = self._HEADER.size + length
+        if available < size:
+            return None, size
+        with memoryview(self._buffer) as view:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(view[self._start + self._HEADER.size:self._start + size], self.max_size)
+            if decompressor.unconsumed_tail:
+                raise ValueError('decompressed frame too large')
+            if not decompressor.eof:
+                raise ValueError('truncated frame')
+        self._start += size
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self._BUFFER_SIZE:
+                self._buffer = bytearray(self._BUFFER_SIZE)
+        return data, 0
+
+    async def _fill(self, size):
+        # дочитать из сокета, чтобы в буфере поместился пакет длиной size; False - соединение закрыто
+        if self._start + size > len(self._buffer):
+            unread = self._end - self._start
+            if size > len(self._buffer):
+                buffer = bytearray(size)
+                buffer[:unread] = self._buffer[self._start:self._end]
+                self._buffer = buffer
+            else:
+                self._buffer[:unread] = self._buffer[self._start:self._end]  # сдвиг в начало буфера
+            self._start, self._end = 0, unread
+        with memoryview(self._buffer) as view:
+            received = await self.loop.sock_recv_into(self.sock, view[self._end:])
+        if not received:
+            return False
+        self._end += received
+        return True
+
+    async def read(self):
+        """следующий пакет (распакованный), None - соединение закрыто или пакет некорректен"""
+        try:
+            while True:
+                data, size = self._frame()
+                if data is not None:
+                    return data
+                if not await self._fill(size):
+                    return
+        except (OSError, ValueError, zlib.error):
+            return
+
+
 class Protocol:
     """Протокол передачи данных поверх TCP
     Суть проста, сегмент состоит из двух полей: HEADER и DATA
@@ -12,43 +92,40 @@ class Protocol:
     Протокол устойчив к работе с медленной сетью, так как построен на TCP.
     Работает на основе asyncio"""
 
-    def __init__(self):
+    def __init__(self, max_frame_size=16 * 1024 * 1024):
         """
         Получить текущий EventLoop
         """
         self.loop = asyncio.get_event_loop()
+        self.max_frame_size = max_frame_size  # больший пакет (сжатый или распакованный) закрывает соединение
+        self._readers = weakref.WeakKeyDictionary()  # сокет -> FrameReader
 
-    async def recv_offset(self, sock, len_packet):
-        # считывать буфер сокета операционной системы до тех пор,
-        # пока нужное количество байт не будет собрано в пакет
-        packet = b''
-        while len(packet) < len_packet:
-            try:
-                data = await self.loop.sock_recv(sock, len_packet - len(packet))
-                if not data:
-                    return
-                packet += data
-            except OSError:
-                return
-        return packet
+    def set_max_frame_size(self, max_frame_size):
+        self.max_frame_size = max_frame_size
+        for reader in self._readers.values():
+            reader.max_size = max_frame_size
 
     async def recv(self, sock):
         # возращает пакет переданный по tcp socket
         # в случае ошибки вернёт None
-        try:
-            header = await self.recv_offset(sock, 4)
-            len_packet = struct.unpack('<I', header)[0]
-            packet = await self.recv_offset(sock, len_packet)
-            return zlib.decompress(packet)
-        except struct.error:
-            return
-        except TypeError:
-            return
+        reader = self._readers.get(sock)
+        if reader is None:
+            reader = self._readers[sock] = FrameReader(sock, self.loop, self.max_frame_size)
+        return await reader.read()
+
+    @staticmethod
+    def pack(msg):
+        # готовый к отправке пакет: заголовок и сжатое сообщение (str или bytes)
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        msg = zlib.compress(msg)  # zip-сжатие строки
+        return struct.pack('<I', len(msg)) + msg
 
     async def send_all(self, sock, msg):
+        # msg - строка сообщения, или уже готовый пакет (bytes из pack)
         try:
-            msg = zlib.compress(msg.encode('utf-8'))  # zip-сжатие строки
-            header = struct.pack('<I', len(msg))
-            await self.loop.sock_sendall(sock, header + msg)
+            if isinstance(msg, str):
+                msg = self.pack(msg)
+            await self.loop.sock_sendall(sock, msg)
         except (OSError, TypeError, struct.error):
-            pass
\ No newline at end of file
+            pass
@@ -1,4 +1,7 @@
+import csv
+import io
 import json
+import math
 import db
 import time
 import sys
@@ -10,9 +13,10 @@ class RequestHandler:
     Основная суть состоит в обработке запроса и отправки ответа на него
     В основном вся логика построена вокруг БД
     """
-    requests = ['GET', 'POST', 'PUT', 'DELETE', 'SERVICE']
+    requests = ['GET', 'POST', 'PUT', 'DELETE', 'BULK', 'SERVICE']
     objects = ['FOLDER', 'HOST', 'USER']
     bad_request = json.dumps({'response': 100, 'data': 'bad request'})
+    bulk_states = ('pause', 'online', 'offline')  # состояния, которые можно задать через BULK
 
     def __init__(self):
         self.parent = None
@@ -20,89 +24,80 @@ class RequestHandler:
     def set_parent_server(self, parent):
         self.parent = parent
 
-    def handler(self, request, login, access='guest'):
+    async def handler(self, request, login, access='guest', sock=None):
         try:
             req = json.loads(request)
             type_req = req['request']
             if type_req in self.requests:
                 if type_req == 'GET':
-                    return self.get(req)
+                    return await self.get(req, access)
                 elif type_req == 'POST':
                     if access == 'admin':
-                        return self.post(req, login, access)
+                        return await self.post(req, login, access)
                     else:
                         self.parent.log.user_event(login, access, '0.0.0.0', 'Не достаточно прав для выполнения запроса: <create>')
                         return self.no_permissions()
                 elif type_req == 'PUT':
                     if access == 'admin':
-                        return self.put(req, login, access)
+                        return await self.put(req, login, access)
                     else:
                         self.parent.log.user_event(login, access, '0.0.0.0', 'Не достаточно прав для выполнения запроса: <update>')
                         return self.no_permissions()
                 elif type_req == 'DELETE':
                     if access == 'admin':
-                        return self.delete(req, login, access)
+                        return await self.delete(req, login, access)
                     else:
                         self.parent.log.user_event(login, access, '0.0.0.0', 'Не достаточно прав для выполнения запроса: <delete>')
                         return self.no_permissions()
+                elif type_req == 'BULK':
+                    if access == 'admin':
+                        return await self.bulk(req, login, access)
+                    else:
+                        self.parent.log.user_event(login, access, '0.0.0.0', 'Не достаточно прав для выполнения запроса: <bulk>')
+                        return self.no_permissions()
                 elif type_req == 'SERVICE':
-                    return self.service(req, login, access)
+                    return await self.service(req, login, access, sock)
             else:
                 return self.bad_request
         except (json.JSONDecodeError, Exception):
             return self.bad_request
 
-    def get(self, r):
+    async def get(self, r, access='guest'):
         try:
             if r['object'] == 'HOST':
                 item = r['item']
-                if item == 'all':
-                    return json.dumps({'response': 200, 'data': db.all_info()})
-
-                elif item == 'dead':
-                    dead_hosts = []
-                    hosts = db.all_info()
-                    for host in hosts:
-                        if host[3] == 'offline' or host[3] == 'clock.offline':
-                            dead_hosts.append(host)
-                    return json.dumps({'response': 200, 'data': dead_hosts})
-
-                elif item == 'live':
-                    live_hosts = []
-                    hosts = db.all_info()
-                    for host in hosts:
-                        if host[3] == 'online' or host[3] == 'clock.online':
-                            live_hosts.append(host)
-                    return json.dumps({'response': 200, 'data': live_hosts})
-
-                elif item == 'pause':
-                    pause_hosts = []
-                    hosts = db.all_info()
-                    for host in hosts:
-                        if host[3] == 'pause':
-                            pause_hosts.append(host)
-                    return json.dumps({'response': 200, 'data': pause_hosts})
+                if item in ('all', 'dead', 'live', 'pause'):
+                    # готовый пакет со списком хостов
+                    return self.parent.snapshot.frame(item)
+
+                elif 'since' in item:
+                    # изменения хостов после ревизии клиента ({'since': ревизия из прошлого ответа})
+                    return json.dumps({'response': 200, 'data': self.parent.host_changes(int(item['since']))})
+
+                elif 'cidr' in item or 'prefix' in item:
+                    # хосты подсети ({'cidr': '10.20.0.0/16'}) или по началу адреса ({'prefix': '10.20.'})
+                    try:
+                        if 'cidr' in item:
+                            hosts = self.parent.hosts.in_network(item['cidr'])
+                        else:
+                            hosts = self.parent.hosts.search(item['prefix'])
+                    except ValueError:
+                        return self.bad_request
+                    return json.dumps({'response': 200, 'data': hosts})
 
                 else:
-                    data = db.one_info(item['ip'])
-                    if data == 'not found':
+                    # из таблицы в памяти - то же состояние, что и в списках хостов
+                    data = self.parent.hosts.get(item['ip'])
+                    if data is None:
                         return json.dumps({'response': 300, 'data': 'not exists'})
-                    elif data == 'unknown error':
-                        return json.dumps({'response': 500, 'data': data})
-                    else:
-                        return json.dumps({'response': 200, 'data': data})
+                    return json.dumps({'response': 200, 'data': data})
 
             elif r['object'] == 'FOLDER':
                 item = r['item']
                 if item == 'all':
-                    return json.dumps({'response': 200, 'data': db.load_folders()})
-                elif db.check_folder_(item['folder_id']):
-                    hosts_in_folder = []
-                    hosts = db.all_info()
-                    for host in hosts:
-                        if host[2] == item['folder_id']:
-                            hosts_in_folder.append(host)
-                    return json.dumps({'response': 200, 'data': hosts_in_folder})
+                    return json.dumps({'response': 200, 'data': await self.parent.db.read(db.load_folders)})
+                elif await self.parent.db.read(db.check_folder_, item['folder_id']):
+                    return self.parent.snapshot.frame(('folder', item['folder_id']))
                 else:
                     return json.dumps({'response': 300, 'data': 'not exists'})
 
@@ -110,9 +105,13 @@ class RequestHandler:
                 item = r['item']
                 if item == 'online':
                     cl = [self.parent.clients[i] for i in self.parent.clients]
+                    if access == 'admin':
+                        # администратору - ещё и состояние очереди отправки каждого клиента
+                        cl = [[*self.parent.clients[i], self.parent.senders[i].stats()]
+                              for i in self.parent.clients if i in self.parent.senders]
                     return json.dumps({'response': 200, 'data': cl})
                 elif item == 'registered':
-                    users = db.registered_users()
+                    users = await self.parent.db.read(db.registered_users)
                     if users:
                         _users = []
                         for user in users:
@@ -122,44 +121,65 @@ class RequestHandler:
                     else:
                         return json.dumps({'response': 500, 'data': ''})
 
+            elif r['object'] == 'STATS':
+                # RTT/jitter/потери хоста за последние проверки
+                stats = self.parent.probe_stats.summary(r['item']['ip'])
+                if stats is None:
+                    return json.dumps({'response': 300, 'data': 'not exists'})
+                return json.dumps({'response': 200, 'data': stats})
+
+            elif r['object'] == 'HISTORY':
+                # RTT/потери хоста за период (по умолчанию - последние сутки)
+                item = r['item']
+                until = float(item.get('until') or time.time())
+                since = float(item.get('since') or until - 86400)
+                if not (math.isfinite(since) and math.isfinite(until)) or since >= until:
+                    return self.bad_request
+                points = await self.parent.history.query_async(item['ip'], since, until, item.get('step'))
+                return json.dumps({'response': 200, 'data': points})
+
             elif r['object'] == 'PINGER':
-                ping_params = db.icmp_params()
+                if r.get('item') == 'stats':
+                    return json.dumps({'response': 200, 'data': self.parent.pinger.stats()})
+                ping_params = await self.parent.db.read(db.icmp_params)
                 if ping_params:
                     return json.dumps({'response': 200, 'data': ping_params})
                 else:
                     return json.dumps({'response': 500, 'data': ''})
 
             elif r['object'] == 'PHONE':
-                phones = db.phone_numbers()
+                phones = await self.parent.db.read(db.phone_numbers)
                 if phones:
                     return json.dumps({'response': 200, 'data': phones})
                 else:
                     return json.dumps({'response': 500, 'data': ''})
 
             elif r['object'] == 'SMS_API':
-                sms_api = db.sms_api()
+                sms_api = await self.parent.db.read(db.sms_api)
                 if sms_api:
                     return json.dumps({'response': 200, 'data': sms_api})
                 else:
                     return json.dumps({'response': 500, 'data': ''})
 
             elif r['object'] == 'LOG_FILE':
-                sms_api = db.sms_api()
-                if sms_api:
-                    return json.dumps({'response': 200, 'data': sms_api})
-                else:
-                    return json.dumps({'response': 500, 'data': ''})
+                # события лога: {'since', 'until', 'type', 'login', 'host', 'cursor', 'limit'} - все необязательны,
+                # следующая страница - запрос с 'cursor' из ответа
+                item = r.get('item') or {}
+                events, cursor = await self.parent.db.read(
+                    db.query_events, item.get('since'), item.get('until'), item.get('type'), item.get('login'),
+                    item.get('host'), item.get('cursor'), max(min(int(item.get('limit') or 100), 1000), 1))
+                return json.dumps({'response': 200, 'data': {'events': events, 'cursor': cursor}})
 
             else:
                 return self.bad_request
         except (OSError, Exception):
             return self.bad_request
 
-    def post(self, r, login, access):
+    async def post(self, r, login, access):
         try:
             if r['object'] == 'HOST':
                 item = r['item']
-                d = db.insert_host(
+                host = (
                     item['ip'],
                     item['name'],
                     item['folder_id'],
@@ -168,24 +188,28 @@ class RequestHandler:
                     item['info'],
                     None
                 )
+                d = await self.parent.db.write(db.insert_host, *host)
 
                 if d == 'unique item error':
                     return json.dumps({'response': 700, 'data': 'DB.host exists'})
                 elif d == 'unknown error':
                     return json.dumps({'response': 500, 'data': 'DB.error'})
                 else:
+                    self.parent.hosts.add(host)
                     self.parent.log.user_event(login, access, '0.0.0.0', f'''добавил новый хост <{item['ip']}>''')
                     return json.dumps({'response': 200, 'data': 'DB.success'})
 
             elif r['object'] == 'FOLDER':
                 item = r['item']
                 try:
-                    d = db.create_folder(
-                        str(max([int(i[0]) for i in db.load_folders()]) + 1),  # генерация уникального id
+                    folders = await self.parent.db.read(db.load_folders)
+                    d = await self.parent.db.write(
+                        db.create_folder,
+                        str(max([int(i[0]) for i in folders]) + 1),  # генерация уникального id
                         item['name']
                     )
                 except (Exception,):
-                    d = db.create_folder(1, item['name'])
+                    d = await self.parent.db.write(db.create_folder, 1, item['name'])
 
                 if d == 'unique item error':
                     return json.dumps({'response': 700, 'data': 'DB.folder exists'})
@@ -197,19 +221,20 @@ class RequestHandler:
 
             elif r['object'] == 'USER':
                 item = r['item']
-                d = db.create_user(item['login'], item['passw'], item['access'])
+                d = await self.parent.db.write(db.create_user, item['login'], item['passw'], item['access'])
 
                 if d == 'unique item error':
                     return json.dumps({'response': 700, 'data': 'DB.user exists'})
                 elif d == 'unknown error':
                     return json.dumps({'response': 500, 'data': 'DB.error'})
                 elif d == 'success':
+                    self.parent.users.invalidate()
                     self.parent.log.user_event(login, access, '0.0.0.0', f'''создал нового пользователя <{item['login']}>''')
                     return json.dumps({'response': 200, 'data': 'DB.success'})
 
             elif r['object'] == 'PHONE':
                 item = r['item']
-                d = db.create_phone_number(item['number'], item['info'])
+                d = await self.parent.db.write(db.create_phone_number, item['number'], item['info'])
 
                 if d == 'unique item error':
                     return json.dumps({'response': 700, 'data': 'DB.phone exists'})
@@ -222,60 +247,66 @@ class RequestHandler:
         except (OSError, Exception):
             return self.bad_request
 
-    def put(self, r, login, access):
+    async def put(self, r, login, access):
         try:
             if r['object'] == 'HOST':
                 item = r['item']
 
-                h = db.one_info(item['new']['ip'])
-                if h == 'not found':
+                if item['new']['ip'] not in self.parent.hosts:
 
-                    h = db.one_info(item['ip'])
-                    if h == 'not found':
+                    if item['ip'] not in self.parent.hosts:
                         return json.dumps({'response': 300, 'data': 'ip not exists'})
 
                     if item['new']['name']:
-                        result = db.change_name(item['ip'], item['new']['name'])
+                        result = await self.parent.db.write(db.change_name, item['ip'], item['new']['name'])
                         if not result == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_name.error'})
+                        self.parent.hosts.apply(item['ip'], name=item['new']['name'])
                         self.parent.log.user_event(login, access, '0.0.0.0',
                                        f'''изменил имя хоста <{item['ip']}> на "{item['new']['name']}"''')
 
                     if item['new']['folder_id']:
-                        result = db.change_folder(item['ip'], item['new']['folder_id'])
+                        result = await self.parent.db.write(db.change_folder, item['ip'], item['new']['folder_id'])
                         if not result == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_folder.error'})
+                        self.parent.hosts.apply(item['ip'], folder=item['new']['folder_id'])
                         self.parent.log.user_event(login, access, '0.0.0.0', f'''изменил ID папки хоста <{item['ip']}>''')
 
                     if item['new']['state']:
-                        result = db.change_state(item['ip'], item['new']['state'])
+                        result = await self.parent.db.write(db.change_state, item['ip'], item['new']['state'])
                         if not result == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_state.error'})
+                        self.parent.hosts.apply(item['ip'], state=item['new']['state'])
                         self.parent.log.user_event(login, access, '0.0.0.0',
                                        f'''изменил состояние хоста <{item['ip']}> на {item['new']['state']}''')
 
                     if item['new']['info']:
-                        result = db.change_info(item['ip'], item['new']['info'])
+                        result = await self.parent.db.write(db.change_info, item['ip'], item['new']['info'])
                         if not result == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_info.error'})
+                        self.parent.hosts.apply(item['ip'], info=item['new']['info'])
                         self.parent.log.user_event(login, access, '0.0.0.0', f'''изменил информацию о хосте <{item['ip']}>''')
 
                     if item['new']['sms']:
-                        result = db.change_sms(item['ip'], item['new']['sms'])
+                        result = await self.parent.db.write(db.change_sms, item['ip'], item['new']['sms'])
                         if not result == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_sms.error'})
+                        self.parent.hosts.apply(item['ip'], sms=item['new']['sms'])
                         self.parent.log.user_event(login, access, '0.0.0.0', f'''изменил SMS оповещения хоста <{item['ip']}>''')
 
                     elif item['new']['sms'] == '':
-                        result = db.change_sms(item['ip'], None)
+                        result = await self.parent.db.write(db.change_sms, item['ip'], None)
                         if not result == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_sms.error'})
+                        self.parent.hosts.apply(item['ip'], sms=None)
                         self.parent.log.user_event(login, access, '0.0.0.0', f'''изменил SMS оповещения хоста <{item['ip']}>''')
 
                     if item['new']['ip']:
-                        result = db.change_ip(item['ip'], item['new']['ip'])
+                        result = await self.parent.db.write(db.change_ip, item['ip'], item['new']['ip'])
                         if not result == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_ip.error'})
+                        self.parent.hosts.rename(item['ip'], item['new']['ip'])
+                        self.parent.probe_stats.rename(item['ip'], item['new']['ip'])
                         self.parent.log.user_event(login, access, '0.0.0.0',
                                        f'''изменил IP хоста <{item['ip']}> на <{item['new']['ip']}>''')
 
@@ -285,19 +316,19 @@ class RequestHandler:
 
             elif r['object'] == 'FOLDER':
                 item = r['item']
-                if db.check_folder_(item['folder_id']):
+                if await self.parent.db.read(db.check_folder_, item['folder_id']):
                     if item['new']['name']:
-                        d = db.change_name_folder(item['folder_id'], item['new']['name'])
+                        d = await self.parent.db.write(db.change_name_folder, item['folder_id'], item['new']['name'])
                         if not d == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_folder.error'})
                         self.parent.log.user_event(login, access, '0.0.0.0',
                                        f'''изменил название папки с id <{item['folder_id']}> на "{item['new']['name']}"''')
 
                     if item['new']['folder_id']:
-                        if db.check_folder_(item['new']['folder_id']):
+                        if await self.parent.db.read(db.check_folder_, item['new']['folder_id']):
                             return json.dumps({'response': 700, 'data': 'id folder already exists'})
                         else:
-                            d = db.change_id_folder(item['folder_id'], item['new']['folder_id'])
+                            d = await self.parent.db.write(db.change_id_folder, item['folder_id'], item['new']['folder_id'])
                             if d == 'success':
                                 self.parent.log.user_event(login, access, '0.0.0.0',
                                                f'''отредактировал папку с id <{item['folder_id']}>''')
@@ -311,17 +342,17 @@ class RequestHandler:
 
             elif r['object'] == 'USER':
                 item = r['item']
-                if db.check_folder_(item['folder_id']):
+                if await self.parent.db.read(db.check_folder_, item['folder_id']):
                     if item['new']['name']:
-                        d = db.change_name_folder(item['folder_id'], item['new']['name'])
+                        d = await self.parent.db.write(db.change_name_folder, item['folder_id'], item['new']['name'])
                         if not d == 'success':
                             return json.dumps({'response': 500, 'data': 'DB.change_folder.error'})
 
                     if item['new']['folder_id']:
-                        if db.check_folder_(item['new']['folder_id']):
+                        if await self.parent.db.read(db.check_folder_, item['new']['folder_id']):
                             return json.dumps({'response': 700, 'data': 'id folder already exists'})
                         else:
-                            d = db.change_id_folder(item['folder_id'], item['new']['folder_id'])
+                            d = await self.parent.db.write(db.change_id_folder, item['folder_id'], item['new']['folder_id'])
                             if d == 'success':
                                 return json.dumps({'response': 200, 'data': 'DB.change_folder.success'})
                             else:
@@ -335,14 +366,16 @@ class RequestHandler:
         except (OSError, Exception):
             return self.bad_request
 
-    def delete(self, r, login, access):
+    async def delete(self, r, login, access):
         try:
             if r['object'] == 'HOST':
                 item = r['item']
 
-                h = db.delete_host(item)
+                h = await self.parent.db.write(db.delete_host, item)
 
                 if h == 'success':
+                    self.parent.hosts.remove(item)
+                    self.parent.probe_stats.remove(item)
                     self.parent.log.user_event(login, access, '0.0.0.0', f'''удалил хост <{item}>''')
                     return json.dumps({'response': 200, 'data': 'DB.delete.success'})
                 elif h == 'not found':
@@ -353,7 +386,7 @@ class RequestHandler:
             elif r['object'] == 'FOLDER':
                 item = r['item']
 
-                h = db.delete_folder(item)
+                h = await self.parent.db.write(db.delete_folder, item)
 
                 if h == 'success':
                     self.parent.log.user_event(login, access, '0.0.0.0', f'''удалил папку с id <{item}>''')
@@ -366,9 +399,10 @@ class RequestHandler:
             elif r['object'] == 'USER':
                 item = r['item']
 
-                h = db.delete_user(item)
+                h = await self.parent.db.write(db.delete_user, item)
 
                 if h == 'success':
+                    self.parent.users.invalidate()
                     self.parent.log.user_event(login, access, '0.0.0.0', f'''удалил учётную запись клиента <{item}>''')
                     return json.dumps({'response': 200, 'data': 'DB.delete.success'})
                 elif h == 'folder not exists':
@@ -379,7 +413,7 @@ class RequestHandler:
             elif r['object'] == 'PHONE':
                 item = r['item']
 
-                h = db.delete_phone(item)
+                h = await self.parent.db.write(db.delete_phone, item)
 
                 if h == 'success':
                     return json.dumps({'response': 200, 'data': 'DB.delete.success'})
@@ -393,26 +427,125 @@ class RequestHandler:
         except (OSError, Exception):
             return self.bad_request
 
-    def service(self, r, login, admin='guest'):
+    @staticmethod
+    def bulk_rows(r):
+        """
+        строки массовой операции: список в item (dict или ip строкой),
+        либо текст в item формата format: 'csv' (первая строка - заголовок с именами полей)
+        или 'ndjson' (по JSON объекту в строке); нечитаемая строка - None
+        """
+        fmt = r.get('format', 'list')
+        if fmt == 'csv':
+            return [row for row in csv.DictReader(io.StringIO(r['item']))]
+        elif fmt == 'ndjson':
+            rows = []
+            for line in r['item'].splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    rows.append(None)
+            return rows
+        return list(r['item'])
+
+    async def bulk(self, r, login, access):
+        """
+        массовое добавление, перенос, пауза или удаление хостов
+        одной транзакцией, с результатом по каждой строке:
+        {'request': 'BULK', 'object': 'HOST', 'command': 'insert'|'move'|'pause'|'delete',
+         'format': 'list'|'csv'|'ndjson', 'item': строки}
+        поля строк: insert - ip, name, folder_id, state, info, sms; move - ip, folder_id;
+        pause - ip, state (по умолчанию 'pause', 'online'/'offline' снимает с паузы); delete - ip
+        state - только 'pause', 'online' или 'offline', иначе строка - 'bad row'
+        """
+        try:
+            command = r['command']
+            func = {'insert': db.insert_hosts, 'move': db.change_folder_hosts,
+                    'pause': db.change_state_hosts, 'delete': db.delete_hosts}.get(command)
+            if r['object'] != 'HOST' or func is None:
+                return self.bad_request
+            rows = []  # (номер строки, аргументы для db)
+            results = []
+            for number, row in enumerate(self.bulk_rows(r)):
+                if isinstance(row, str):
+                    row = {'ip': row}
+                try:
+                    if not row.get('ip'):
+                        raise ValueError(row)
+                    if command == 'insert':
+                        sms = row.get('sms') or None
+                        if isinstance(sms, dict):
+                            sms = json.dumps(sms)
+                        state = row.get('state') or 'offline'
+                        if state not in self.bulk_states:
+                            raise ValueError(state)
+                        args = (row['ip'], row.get('name') or '', row['folder_id'], state,
+                                time.time(), row.get('info') or '', sms)
+                    elif command == 'move':
+                        args = (row['folder_id'], row['ip'])
+                    elif command == 'pause':
+                        state = row.get('state') or 'pause'
+                        if state not in self.bulk_states:
+                            raise ValueError(state)
+                        args = (state, row['ip'])
+                    else:
+                        args = row['ip']
+                except (AttributeError, KeyError, ValueError):
+                    results.append('bad row')
+                    continue
+                results.append(None)
+                rows.append((number, args))
+
+            done = await self.parent.db.write(func, [args for _, args in rows]) if rows else []
+            if done == 'unknown error':
+                return json.dumps({'response': 500, 'data': 'DB.error'})
+
+            for (number, args), result in zip(rows, done):
+                results[number] = result
+                if result != 'success':
+                    continue
+                if command == 'insert':
+                    self.parent.hosts.add(args)
+                elif command == 'move':
+                    self.parent.hosts.apply(args[1], folder=args[0])
+                elif command == 'pause':
+                    self.parent.hosts.apply(args[1], state=args[0])
+                else:
+                    self.parent.hosts.remove(args)
+                    self.parent.probe_stats.remove(args)
+
+            success = results.count('success')
+            self.parent.log.user_event(login, access, '0.0.0.0',
+                                       f'''массовая операция с хостами <{command}>: выполнено {success} из {len(results)}''')
+            return json.dumps({'response': 200, 'data': {'success': success,
+                                                         'errors': len(results) - success,
+                                                         'results': results}})
+        except (OSError, Exception):
+            return self.bad_request
+
+    async def service(self, r, login, admin='guest', sock=None):
         command = r['command']
         item = r['item']
 
         try:
             if command == 10:
-                self.parent.pinger.start_ping_all()
+                status = self.parent.pinger.start_ping_all()
                 self.parent.log.user_event(login, admin, '0.0.0.0', 'запустил проверку всех хостов')
-                return json.dumps({'response': 200, 'data': ''})
+                return json.dumps({'response': 200, 'data': status})
             elif command == 20:
                 if item:
-                    self.parent.pinger.start_ping_one(item)
+                    status = self.parent.pinger.start_ping_one(item)
+                    if status == 'not found':
+                        return json.dumps({'response': 300, 'data': 'not exists'})
                     self.parent.log.user_event(login, admin, '0.0.0.0', f'запустил проверку одного хоста <{item}>')
-                    return json.dumps({'response': 200, 'data': ''})
+                    return json.dumps({'response': 200, 'data': status})
                 else:
                     return self.bad_request
             elif command == 21:
-                self.parent.pinger.start_ping_dead()
+                status = self.parent.pinger.start_ping_dead()
                 self.parent.log.user_event(login, admin, '0.0.0.0', 'запустил проверку недоступных хостов')
-                return json.dumps({'response': 200, 'data': ''})
+                return json.dumps({'response': 200, 'data': status})
 
             elif command == 82:
                 if item:
@@ -420,15 +553,29 @@ class RequestHandler:
                 else:
                     return self.bad_request
 
+            elif command == 83:
+                # статистика пингера: скорость проверки, очередь хостов
+                return json.dumps({'response': 200, 'data': self.parent.pinger.stats()})
+
+            elif command == 84:
+                # очередь повторной проверки отключившихся хостов перед SMS оповещением
+                return json.dumps({'response': 200, 'data': self.parent.pinger.confirmations.stats()})
+
+            elif command == 85:
+                # формат icmp событий этого клиента: 1 - пачками (response 34), 0 - по одному (response 33)
+                self.parent.set_batched_events(sock, bool(item))
+                return json.dumps({'response': 200, 'data': {'batched': sock in self.parent.batched_clients,
+                                                             **self.parent.icmp_batcher.stats()}})
+
             elif admin != 'admin':
                 return self.no_permissions()
 
             elif command == 30:
                 self.parent.log.user_event(login, admin, '0.0.0.0', 'reboot/off server')
-                sys.exit()
+                sys.exit()  # SystemExit останавливает цикл событий, запись в БД - в finally run.py
             elif command == 40:
                 if item:
-                    if db.icmp_params_update(ping_hosts_per_sec=int(item)) != 'success':
+                    if (await self.parent.db.write(db.icmp_params_update, ping_hosts_per_sec=int(item))) != 'success':
                         return json.dumps({'response': 500, 'data': 'DB.error'})
                     self.parent.pinger.set_icmp_per_second(int(item))
                     self.parent.log.user_event(login, admin, '0.0.0.0', 'изменил парметры проверки хостов <скорость проверки>')
@@ -437,7 +584,7 @@ class RequestHandler:
                     return self.bad_request
             elif command == 50:
                 if item:
-                    if db.icmp_params_update(icmp_with_host=int(item)) != 'success':
+                    if (await self.parent.db.write(db.icmp_params_update, icmp_with_host=int(item))) != 'success':
                         return json.dumps({'response': 500, 'data': 'DB.error'})
                     self.parent.pinger.set_icmp_count(int(item))
                     self.parent.log.user_event(login, admin, '0.0.0.0',
@@ -447,7 +594,7 @@ class RequestHandler:
                     return self.bad_request
             elif command == 60:
                 if item:
-                    if db.icmp_params_update(icmp_interval=int(item)) != 'success':
+                    if (await self.parent.db.write(db.icmp_params_update, icmp_interval=int(item))) != 'success':
                         return json.dumps({'response': 500, 'data': 'DB.error'})
                     self.parent.pinger.set_icmp_interval(int(item))
                     self.parent.log.user_event(login, admin, '0.0.0.0', 'изменил парметры проверки хостов <интервал icmp>')
@@ -456,7 +603,7 @@ class RequestHandler:
                     return self.bad_request
             elif command == 70:
                 if item:
-                    if db.icmp_params_update(auto_ping=int(item)) != 'success':
+                    if (await self.parent.db.write(db.icmp_params_update, auto_ping=int(item))) != 'success':
                         return json.dumps({'response': 500, 'data': 'DB.error'})
                     self.parent.pinger.set_auto_ping_interval(int(item))
                     self.parent.log.user_event(login, admin, '0.0.0.0', 'изменил парметры проверки хостов <частота проверок>')
@@ -465,7 +612,7 @@ class RequestHandler:
                     return self.bad_request
             elif command == 80:
                 if item:
-                    if db.icmp_params_update(icmp_timeout=int(item)) != 'success':
+                    if (await self.parent.db.write(db.icmp_params_update, icmp_timeout=int(item))) != 'success':
                         return json.dumps({'response': 500, 'data': 'DB.error'})
                     self.parent.pinger.set_icmp_timeout(int(item))
                     self.parent.log.user_event(login, admin, '0.0.0.0', 'изменил парметры проверки хостов <icmp timeout>')
@@ -0,0 +1,179 @@
+"""AlertDispatcher и HTTPPool против локальной заглушки SMS шлюза"""
+import asyncio
+import json
+
+import db
+from alerts import AlertDispatcher, HTTPPool
+
+
+class StubGateway:
+    """HTTP сервер на 127.0.0.1: запоминает запросы, отвечает кодами из statuses (затем 200)"""
+
+    def __init__(self, statuses=(), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = []  # (метод, путь, тело)
+        self.active = 0
+        self.max_active = 0
+        self.connections = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _client(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path = line.decode('latin-1').split()[:2]
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                body = await reader.readexactly(length)
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+                await asyncio.sleep(self.delay)
+                self.active -= 1
+                self.requests.append((method, path, body.decode('utf-8')))
+                status = self.statuses.pop(0) if self.statuses else 200
+                writer.write(f'HTTP/1.1 {status} X\r\nContent-Length: 2\r\n\r\nok'.encode('latin-1'))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+class FakeDatabase:
+    """AsyncDB для AlertDispatcher: настройки шлюза и номера в памяти, записи запоминаются"""
+
+    def __init__(self, port, phones):
+        self.gateway = (f'127.0.0.1:{port}', '/send', '{"phone": "{phone}", "text": "{text}"}', 3)
+        self.phones = phones
+        self.writes = []  # (функция, аргументы)
+        self._ids = 0
+
+    async def read(self, func, *args):
+        if func is db.sms_api:
+            return [self.gateway]
+        if func is db.phone_numbers:
+            return [(phone,) for phone in self.phones]
+        if func is db.pending_alerts:
+            return []
+        raise AssertionError(func)
+
+    async def write(self, func, *args):
+        self.writes.append((func, args))
+        if func is db.insert_alerts:
+            ids = list(range(self._ids, self._ids + len(args[0])))
+            self._ids += len(ids)
+            return ids
+        return 'success'
+
+    def written(self, func):
+        return [args for written, args in self.writes if written is func]
+
+
+async def _dispatch(gateway, phones, texts, until, url=None):
+    # запустить AlertDispatcher с короткими паузами, пока не выполнится until(dispatcher)
+    database = FakeDatabase(gateway.port, phones)
+    dispatcher = AlertDispatcher(database=database)
+    dispatcher._BATCH_WINDOW = 0.05
+    dispatcher._RETRY_BASE = 0.1
+    task = asyncio.get_event_loop().create_task(dispatcher.run())
+    await asyncio.sleep(0)
+    for text in texts:
+        dispatcher.push(text, url)
+    try:
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            if until(dispatcher):
+                break
+    finally:
+        task.cancel()
+        dispatcher.http.close()
+    return dispatcher, database
+
+
+def test_delivery_batches_alerts_per_phone():
+    async def main():
+        gateway = StubGateway()
+        await gateway.start()
+        dispatcher, database = await _dispatch(gateway, ['100', '200'], ['Хост <1> отключился', 'Хост <2> "x"'],
+                                               lambda d: d.stats()['sent'] == 4)
+        gateway.close()
+        return dispatcher, database, gateway
+
+    dispatcher, database, gateway = asyncio.run(main())
+    assert dispatcher.stats()['sent'] == 4
+    assert len(gateway.requests) == 2  # один запрос на номер со всеми сообщениями
+    bodies = sorted(json.loads(body)['phone'] for _, _, body in gateway.requests)
+    assert bodies == ['100', '200']
+    for method, path, body in gateway.requests:
+        assert (method, path) == ('POST', '/send')
+        assert json.loads(body)['text'] == 'Хост <1> отключился\nХост <2> "x"'
+    assert sorted(sum((list(args[0]) for args in database.written(db.delete_alerts)), [])) == [0, 1, 2, 3]
+
+
+def test_failed_delivery_is_retried():
+    async def main():
+        gateway = StubGateway(statuses=[500])
+        await gateway.start()
+        dispatcher, database = await _dispatch(gateway, ['100'], ['Хост <1> отключился'],
+                                               lambda d: d.stats()['sent'] == 1)
+        gateway.close()
+        return dispatcher, database, gateway
+
+    dispatcher, database, gateway = asyncio.run(main())
+    stats = dispatcher.stats()
+    assert (stats['sent'], stats['failed_requests'], stats['pending']) == (1, 1, 0)
+    assert len(gateway.requests) == 2
+    assert [row[0] for args in database.written(db.update_alerts) for row in args[0]] == [1]  # attempts
+
+
+def test_url_recipient_gets_one_request_per_alert():
+    async def main():
+        gateway = StubGateway(statuses=[200, 500])
+        await gateway.start()
+        url = f'http://127.0.0.1:{gateway.port}/hook?host=1'
+        dispatcher, database = await _dispatch(gateway, [], ['включился', 'отключился', 'включился'],
+                                               lambda d: d.stats()['sent'] == 3, url=url)
+        gateway.close()
+        return dispatcher, gateway
+
+    dispatcher, gateway = asyncio.run(main())
+    stats = dispatcher.stats()
+    assert (stats['sent'], stats['failed_requests'], stats['pending']) == (3, 1, 0)
+    # первое доставлено, на втором шлюз ответил 500 - повторяются только второе и третье
+    assert [request[:2] for request in gateway.requests] == [('GET', '/hook?host=1')] * 4
+
+
+def test_pool_limits_concurrent_requests_and_reuses_connections():
+    async def main():
+        gateway = StubGateway(delay=0.05)
+        await gateway.start()
+        pool = HTTPPool(limit=2)
+        url = f'http://127.0.0.1:{gateway.port}/send'
+        statuses = await asyncio.gather(*(pool.request('POST', url, b'x') for _ in range(6)))
+        pool.close()
+        gateway.close()
+        return statuses, pool, gateway
+
+    statuses, pool, gateway = asyncio.run(main())
+    assert statuses == [200] * 6
+    assert gateway.max_active <= 2
+    assert pool.opened == gateway.connections == 2
+    assert pool.requests == 6